@@ -0,0 +1,94 @@
+#
+# Benchmark: aggregate pushdown (partial aggregates on every partition at once, merged in Python) vs. one
+# GROUP BY on the base table, for the usual analytics questions.
+#
+# Expects the ratings table and partitions of --partition-type to exist in the database configured in .env,
+# e.g. after running tests/Assignment1Tester.py or MyAssignment.rangepartition('ratings', 5) on the 10M dataset.
+# Exact aggregates are checked against the GROUP BY result; for DistinctCount the relative error is shown.
+#
+#   python benchmarks/aggregate_benchmark.py --partition-type range --repeat 3
+#
+RATINGS_TABLE = 'ratings'
+
+import argparse
+import os
+import statistics
+import sys
+import time
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import src.Interface as MyAssignment
+from src.aggregate import Avg, Count, DistinctCount, Histogram, Max, Min, Quantiles, aggregate
+
+# (tên, câu GROUP BY trên bảng gốc, các aggregate tương ứng, cột nhóm)
+SCENARIOS = [
+    ('avg rating per movie',
+     f"SELECT movieid, avg(rating), count(*) FROM {RATINGS_TABLE} GROUP BY movieid ORDER BY movieid",
+     [Avg('rating'), Count()], ['movieid']),
+    ('ratings per user',
+     f"SELECT userid, count(*), min(rating), max(rating) FROM {RATINGS_TABLE} GROUP BY userid ORDER BY userid",
+     [Count(), Min('rating'), Max('rating')], ['userid']),
+    ('rating histogram',
+     f"SELECT rating, count(*) FROM {RATINGS_TABLE} GROUP BY rating ORDER BY rating",
+     [Histogram('rating')], []),
+    ('median rating per movie',
+     f"SELECT movieid, percentile_disc(0.5) WITHIN GROUP (ORDER BY rating) FROM {RATINGS_TABLE} "
+     f"GROUP BY movieid ORDER BY movieid",
+     [Quantiles('rating', (0.5,))], ['movieid']),
+    ('distinct users and movies',
+     f"SELECT count(DISTINCT userid), count(DISTINCT movieid) FROM {RATINGS_TABLE}",
+     [DistinctCount('userid'), DistinctCount('movieid')], []),
+]
+
+
+def timed(func, repeat):
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        runs.append(time.perf_counter() - start)
+    return result, statistics.median(runs)
+
+
+def group_by(conn, query):
+    def run():
+        with conn.cursor() as cur:
+            cur.execute(query)
+            rows = cur.fetchall()
+        conn.commit()
+        return rows
+    return run
+
+
+def check(expected, actual, aggregates, groupby):
+    """Mô tả sai lệch giữa kết quả pushdown và GROUP BY; chuỗi rỗng nếu khớp"""
+    if isinstance(aggregates[0], Histogram) and not isinstance(aggregates[0], Quantiles):
+        return "" if actual[0][0] == dict(expected) else "MISMATCH"
+    if isinstance(aggregates[0], DistinctCount):
+        return "error " + ", ".join(f"{estimate / exact - 1:+.2%}" for estimate, exact in zip(actual[0], expected[0]))
+    if len(expected) != len(actual):
+        return f"MISMATCH: {len(actual)} groups, expected {len(expected)}"
+    for row, values in zip(actual, expected):
+        row = [value[0] if isinstance(value, tuple) else value for value in row]
+        if any(abs(a - b) > 1e-9 if isinstance(a, float) else a != b for a, b in zip(row, values)):
+            return f"MISMATCH at {row[:len(groupby)]}"
+    return ""
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Aggregate pushdown vs. GROUP BY on the base table")
+    parser.add_argument('--partition-type', choices=['range', 'rrobin', 'hash'], default=None,
+                        help="partitions to aggregate over (default: the first that exists)")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per scenario; the median is reported")
+    args = parser.parse_args()
+
+    conn = MyAssignment.getopenconnection()
+    try:
+        for name, query, aggregates, groupby in SCENARIOS:
+            expected, base_seconds = timed(group_by(conn, query), args.repeat)
+            actual, seconds = timed(lambda: aggregate(RATINGS_TABLE, aggregates, groupby,
+                                                      partition_type=args.partition_type), args.repeat)
+            print(f"{name:<28} GROUP BY {base_seconds:8.3f}s | pushdown {seconds:8.3f}s "
+                  f"({base_seconds / seconds:5.2f}x)  {check(expected, actual, aggregates, groupby)}")
+    finally:
+        MyAssignment.close_connection_pool()
+        conn.close()
@@ -0,0 +1,107 @@
+#
+# Benchmark: thousands of concurrent single-row inserts through the asyncio interface (one event loop thread,
+# DB_POOL_MAX connections) vs. the blocking interface with one thread per in-flight insert.
+#
+# Expects the ratings table and its range and round-robin partitions to exist in the database configured in .env,
+# e.g. after running tests/Assignment1Tester.py. The inserted rows use userids above FIRST_USERID and are
+# deleted again afterwards. Every insert of a scenario is issued at once, so latencies include the wait for a
+# connection (async) or a thread (sync).
+#
+#   python benchmarks/async_insert_benchmark.py --inserts 5000 --threads 10 100 500
+#
+RATINGS_TABLE = 'ratings'
+FIRST_USERID = 10000000
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import src.Interface as MyAssignment
+import src.async_interface as AsyncAssignment
+
+
+def new_rows(count, first_userid):
+    for i in range(count):
+        yield first_userid + i // 1000, i % 1000 + 1, (i % 10 + 1) / 2
+
+
+def cleanup(first_userid):
+    conn = MyAssignment.getopenconnection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT table_name FROM information_schema.tables "
+                        "WHERE table_schema = 'public' AND table_name ~ '^(range|rrobin)_part[0-9]+$'")
+            for table in [RATINGS_TABLE] + [row[0] for row in cur.fetchall()]:
+                cur.execute(f"DELETE FROM {table} WHERE userid >= %s;", (first_userid,))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def summary(name, latencies, seconds, threads):
+    latencies.sort()
+    p99 = latencies[min(len(latencies) - 1, int(0.99 * len(latencies)))]
+    print(f"{name:<32} {seconds:7.2f} s  {len(latencies) / seconds:8.0f} inserts/sec  "
+          f"p50 {statistics.median(latencies) * 1000:7.1f} ms  p99 {p99 * 1000:7.1f} ms  {threads:4d} threads")
+
+
+async def run_async(insert, rows):
+    latencies = []
+
+    async def one(row):
+        start = time.perf_counter()
+        await insert(RATINGS_TABLE, *row)
+        latencies.append(time.perf_counter() - start)
+
+    try:
+        # Tạo pool trước để thời gian mở kết nối không tính vào kết quả
+        await AsyncAssignment.get_connection_pool()
+        start = time.perf_counter()
+        await asyncio.gather(*(one(row) for row in rows))
+        return latencies, time.perf_counter() - start, threading.active_count()
+    finally:
+        await AsyncAssignment.close_connection_pool()
+
+
+def run_threads(insert, rows, threads):
+    latencies = []
+    peak = 0
+
+    def one(row):
+        nonlocal peak
+        insert(RATINGS_TABLE, *row)
+        latencies.append(time.perf_counter() - start)
+        peak = max(peak, threading.active_count())
+
+    MyAssignment.get_connection_pool()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(one, rows))
+    return latencies, time.perf_counter() - start, peak
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Concurrent insert throughput: asyncio vs. threads")
+    parser.add_argument('--inserts', type=int, default=5000, help="inserts in flight at once per scenario")
+    parser.add_argument('--threads', type=int, nargs='+', default=[10, 100], help="thread counts for the sync runs")
+    args = parser.parse_args()
+
+    first_userid = FIRST_USERID
+    try:
+        for name in ('rangeinsert', 'roundrobininsert'):
+            rows = list(new_rows(args.inserts, first_userid))
+            first_userid += args.inserts // 1000 + 1
+            summary(f"async {name}", *asyncio.run(run_async(getattr(AsyncAssignment, name), rows)))
+
+            for threads in args.threads:
+                rows = list(new_rows(args.inserts, first_userid))
+                first_userid += args.inserts // 1000 + 1
+                summary(f"{name} x{threads} threads", *run_threads(getattr(MyAssignment, name), rows, threads))
+    finally:
+        MyAssignment.close_connection_pool()
+        cleanup(FIRST_USERID)
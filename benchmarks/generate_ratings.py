@@ -0,0 +1,58 @@
+#
+# Deterministic synthetic ratings.dat generator (MovieLens format: UserID::MovieID::Rating::Timestamp)
+#
+# The same (rows, skew, seed) always produces a byte-identical file. Ratings follow a Zipf-like law over
+# the MovieLens rating values ranked by how common they are in ml-10m: with --skew 0 every value is equally
+# likely, with the default 1.0 about a quarter of the rows rate 4.0 and a tiny share 0.5.
+#
+#   python benchmarks/generate_ratings.py 10M /tmp/ratings-10M.dat --skew 1.0 --seed 42
+#
+RATING_VALUES = [4.0, 3.0, 5.0, 3.5, 4.5, 2.0, 2.5, 1.0, 1.5, 0.5]   # Theo thứ tự phổ biến giảm dần
+RATINGS_PER_USER = 143          # Trung bình của ml-10m: 10000054 dòng / 69878 người dùng
+MOVIES = 65133
+FIRST_TIMESTAMP = 789652009
+CHUNK_ROWS = 100000
+
+import argparse
+import itertools
+import random
+
+
+def parse_rows(text) -> int:
+    """'1M', '10M', '50M', '200k' hoặc một số nguyên"""
+    text = text.strip().upper()
+    multiplier = {'K': 10 ** 3, 'M': 10 ** 6}.get(text[-1:], 1)
+    return int(float(text[:-1] if multiplier > 1 else text) * multiplier)
+
+
+def rating_weights(skew) -> list[float]:
+    return [1.0 / (rank + 1) ** skew for rank in range(len(RATING_VALUES))]
+
+
+def generate(filepath, rows, skew=1.0, seed=42) -> None:
+    """Write @rows ratings to @filepath; (userid, movieid) pairs are unique"""
+    rnd = random.Random(seed)
+    cum_weights = list(itertools.accumulate(rating_weights(skew)))
+    values = [f"{value:g}" for value in RATING_VALUES]
+
+    with open(filepath, 'w', newline='\n') as f:
+        for start in range(0, rows, CHUNK_ROWS):
+            count = min(CHUNK_ROWS, rows - start)
+            ratings = rnd.choices(values, cum_weights=cum_weights, k=count)
+            lines = []
+            for i, rating in zip(range(start, start + count), ratings):
+                userid, n = divmod(i, RATINGS_PER_USER)
+                # Bước nhảy nguyên tố cùng nhau với MOVIES: các movieid của một người dùng khác nhau và rải đều
+                movieid = (userid * 7919 + n * 104729) % MOVIES + 1
+                lines.append(f"{userid + 1}::{movieid}::{rating}::{FIRST_TIMESTAMP + i}\n")
+            f.write(''.join(lines))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate a deterministic synthetic ratings.dat")
+    parser.add_argument('rows', type=parse_rows, help="number of rows, e.g. 1M, 10M, 50M")
+    parser.add_argument('output')
+    parser.add_argument('--skew', type=float, default=1.0, help="Zipf exponent of the rating distribution")
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    generate(args.output, args.rows, args.skew, args.seed)
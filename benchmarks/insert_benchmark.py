@@ -0,0 +1,104 @@
+#
+# Benchmark: single-row rangeinsert/roundrobininsert vs. rangeinsert_many/roundrobininsert_many, and many producer
+# threads inserting single rows directly vs. through the group-commit RatingWriter
+#
+# WARNING: drops and recreates the ratings table and the range_part/rrobin_part partitions
+# of the database configured in .env. Run it against a throwaway database only.
+#
+RATINGS_TABLE = 'ratings'
+NUMBER_OF_PARTITIONS = 5
+SINGLE_ROW_INSERTS = 2000      # Số dòng chèn lần lượt qua rangeinsert / roundrobininsert
+BATCHED_INSERTS = 200000       # Số dòng chèn qua *_many
+BATCH_SIZE = 10000
+PRODUCERS = 8                  # Số luồng cùng chèn từng dòng, trực tiếp hoặc qua RatingWriter
+PRODUCER_INSERTS = 4000        # Số dòng mỗi kịch bản chèn đồng thời
+
+import os
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import src.Interface as MyAssignment
+from src.writer import RatingWriter
+
+
+def generate_rows(count, offset=0, seed=42):
+    """Sinh các bộ (userid, movieid, rating) không trùng khoá"""
+    rnd = random.Random(seed)
+    for i in range(offset, offset + count):
+        yield i // 1000 + 1, i % 1000 + 1, rnd.randint(1, 10) / 2
+
+
+def reset_tables(conn):
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            DROP TABLE IF EXISTS {RATINGS_TABLE};
+            CREATE TABLE {RATINGS_TABLE} (
+                userid INT,
+                movieid INT,
+                rating FLOAT,
+                PRIMARY KEY (userid, movieid)
+            );
+        """)
+    conn.commit()
+    MyAssignment.rangepartition(RATINGS_TABLE, NUMBER_OF_PARTITIONS, conn)
+    MyAssignment.roundrobinpartition(RATINGS_TABLE, NUMBER_OF_PARTITIONS, conn)
+
+
+def bench_single(conn, insert):
+    rows = list(generate_rows(SINGLE_ROW_INSERTS))
+    start = time.time()
+    for userid, movieid, rating in rows:
+        insert(RATINGS_TABLE, userid, movieid, rating, conn)
+    return len(rows) / (time.time() - start)
+
+
+def bench_batched(conn, insert_many):
+    rows = list(generate_rows(BATCHED_INSERTS, offset=SINGLE_ROW_INSERTS))
+    start = time.time()
+    for i in range(0, len(rows), BATCH_SIZE):
+        insert_many(RATINGS_TABLE, rows[i:i + BATCH_SIZE], conn)
+    return len(rows) / (time.time() - start)
+
+
+def bench_producers(insert, offset):
+    """PRODUCERS luồng, mỗi dòng một transaction qua kết nối trong pool"""
+    rows = list(generate_rows(PRODUCER_INSERTS, offset=offset))
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=PRODUCERS) as executor:
+        list(executor.map(lambda row: insert(RATINGS_TABLE, *row), rows))
+    return len(rows) / (time.time() - start)
+
+
+def bench_writer(partition_type, offset):
+    """PRODUCERS luồng gửi từng dòng vào RatingWriter và chờ đến khi dòng đó được commit"""
+    rows = list(generate_rows(PRODUCER_INSERTS, offset=offset))
+    start = time.time()
+    with RatingWriter(RATINGS_TABLE, partition_type) as writer, \
+            ThreadPoolExecutor(max_workers=PRODUCERS) as executor:
+        list(executor.map(lambda row: writer.submit(*row).result(), rows))
+    return len(rows) / (time.time() - start)
+
+
+if __name__ == '__main__':
+    conn = MyAssignment.getopenconnection()
+    try:
+        for name, insert, insert_many in (
+                ('range', MyAssignment.rangeinsert, MyAssignment.rangeinsert_many),
+                ('rrobin', MyAssignment.roundrobininsert, MyAssignment.roundrobininsert_many)):
+            # Mỗi lượt chèn cùng các khoá, nên dựng lại bảng gốc và phân mảnh rỗng trước mỗi lượt
+            reset_tables(conn)
+            single = bench_single(conn, insert)
+            batched = bench_batched(conn, insert_many)
+            print(f"{name:>6}: single-row {single:10.0f} rows/sec | "
+                  f"batched ({BATCH_SIZE}/batch) {batched:10.0f} rows/sec | x{batched / single:.1f}")
+
+            offset = SINGLE_ROW_INSERTS + BATCHED_INSERTS
+            producers = bench_producers(insert, offset)
+            writer = bench_writer(name, offset + PRODUCER_INSERTS)
+            print(f"{name:>6}: {PRODUCERS} producers, single-row {producers:10.0f} rows/sec | "
+                  f"RatingWriter {writer:10.0f} rows/sec | x{writer / producers:.1f}")
+    finally:
+        conn.close()
+        MyAssignment.close_connection_pool()
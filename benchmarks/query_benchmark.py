@@ -0,0 +1,55 @@
+#
+# Benchmark: partition-pruned, fan-out rangequery / pointquery vs. a full scan of the base table
+#
+# Expects the ratings table and its range partitions to exist in the database configured in .env,
+# e.g. after running tests/Assignment1Tester.py or MyAssignment.rangepartition(...).
+#
+RATINGS_TABLE = 'ratings'
+RANGE_QUERIES = [(0.0, 1.0), (3.5, 4.0), (4.5, 5.0), (0.0, 5.0)]
+POINT_QUERIES = 20
+
+import os
+import sys
+import time
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import src.Interface as MyAssignment
+import src.query as Query
+
+
+def full_scan(conn, query, params):
+    start = time.time()
+    with conn.cursor() as cur:
+        cur.execute(query, params)
+        rows = len(cur.fetchall())
+    return rows, time.time() - start
+
+
+if __name__ == '__main__':
+    conn = MyAssignment.getopenconnection()
+    try:
+        for lo, hi in RANGE_QUERIES:
+            result = Query.rangequery(RATINGS_TABLE, lo, hi)
+            rows = sum(1 for _ in result)
+            base_rows, base_seconds = full_scan(
+                conn, f"SELECT userid, movieid, rating FROM {RATINGS_TABLE} WHERE rating >= %s AND rating <= %s",
+                (lo, hi))
+            assert rows == base_rows, (rows, base_rows)
+            print(f"rangequery [{lo}, {hi}]: {rows} rows, {len(result.partitions)}/{result.partitions_total} "
+                  f"partitions in {result.elapsed:.3f}s | full scan {base_seconds:.3f}s")
+
+        with conn.cursor() as cur:
+            cur.execute(f"SELECT userid, movieid FROM {RATINGS_TABLE} LIMIT %s", (POINT_QUERIES,))
+            keys = cur.fetchall()
+        start = time.time()
+        for userid, movieid in keys:
+            result = Query.pointquery(RATINGS_TABLE, userid, movieid)
+            assert len(list(result)) == 1
+        point_seconds = (time.time() - start) / len(keys)
+        base_seconds = sum(
+            full_scan(conn, f"SELECT * FROM {RATINGS_TABLE} WHERE userid = %s AND movieid = %s", key)[1]
+            for key in keys) / len(keys)
+        print(f"pointquery: {len(result.partitions)}/{result.partitions_total} partitions, "
+              f"{point_seconds * 1000:.2f} ms/query | base table {base_seconds * 1000:.2f} ms/query")
+    finally:
+        MyAssignment.close_connection_pool()
+        conn.close()
@@ -0,0 +1,310 @@
+#
+# Reproducible benchmark suite: load (against the original StringIO loader, time and peak memory), range/round-robin
+# partitioning at several N, single-row and batched inserts, and partition verification, on a deterministic
+# synthetic dataset. Results are written as JSON;
+# `compare` flags scenarios that got slower between two result files.
+#
+#   python benchmarks/suite.py run --rows 1M --out base.json
+#   python benchmarks/suite.py run --rows 1M --out new.json
+#   python benchmarks/suite.py compare base.json new.json --threshold 0.10
+#
+# WARNING: `run` drops every public table of the database configured in .env. Use a throwaway database only.
+#
+RATINGS_TABLE = 'ratings'
+PARTITION_COUNTS = [5, 20]
+SINGLE_ROW_INSERTS = 1000
+BATCHED_INSERTS = 100000
+BATCH_SIZE = 10000
+DATA_DIR = None                 # Thư mục chứa các file ratings sinh ra; None: <thư mục tạm>/ratings-bench
+
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from io import StringIO
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tests'))
+import src.Interface as MyAssignment
+import src.metrics as metrics
+import testHelper
+from generate_ratings import RATINGS_PER_USER, generate, parse_rows
+
+
+def dataset(rows, skew, seed) -> str:
+    """Đường dẫn file dữ liệu cho (rows, skew, seed), sinh ra nếu chưa có"""
+    directory = DATA_DIR or os.path.join(tempfile.gettempdir(), 'ratings-bench')
+    os.makedirs(directory, exist_ok=True)
+    filepath = os.path.join(directory, f"ratings-{rows}-skew{skew:g}-seed{seed}.dat")
+    if not os.path.exists(filepath):
+        start = time.time()
+        generate(filepath + '.tmp', rows, skew, seed)
+        os.replace(filepath + '.tmp', filepath)
+        print(f"Generated {filepath} in {time.time() - start:.1f} seconds")
+    return filepath
+
+
+def stringio_loadratings(ratingstablename, ratingsfilepath, openconnection):
+    """Bộ nạp ban đầu, giữ lại để so sánh: dựng cả file trong một StringIO rồi COPY một lần"""
+    with openconnection.cursor() as cur:
+        cur.execute(f"DROP TABLE IF EXISTS {ratingstablename};")
+        cur.execute(f"CREATE TABLE {ratingstablename} (userid INT, movieid INT, rating FLOAT);")
+        buffer = StringIO()
+        with open(ratingsfilepath, 'r') as f:
+            for line in f:
+                parts = line.strip().split('::')
+                if len(parts) >= 3:
+                    buffer.write(f"{parts[0]}\t{parts[1]}\t{parts[2]}\n")
+        buffer.seek(0)
+        cur.copy_from(buffer, ratingstablename, sep='\t', columns=('userid', 'movieid', 'rating'))
+        cur.execute(f"ALTER TABLE {ratingstablename} ADD PRIMARY KEY (userid, movieid);")
+    openconnection.commit()
+
+
+LOADERS = {
+    'load': lambda filepath, conn: MyAssignment.loadratings(RATINGS_TABLE, filepath, conn),
+    'load_stringio': lambda filepath, conn: stringio_loadratings(RATINGS_TABLE, filepath, conn),
+}
+
+
+def load_memory(name, filepath) -> dict:
+    """
+    Chạy bộ nạp @name một lần trong tiến trình này với tracemalloc: MB cấp phát Python cao nhất, và MB RSS cao nhất
+    (ru_maxrss là đỉnh của cả đời tiến trình, nên load_memory chạy trong một tiến trình mới cho mỗi lần nạp)
+    """
+    conn = MyAssignment.getopenconnection()
+    try:
+        tracemalloc.start()
+        LOADERS[name](filepath, conn)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+        conn.close()
+        MyAssignment.close_connection_pool()
+    return {'peak_alloc_mb': peak / 2 ** 20, 'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+
+def new_rows(count, first_userid):
+    """Các dòng chèn thêm với userid nằm ngoài tập dữ liệu để không trùng khoá"""
+    for i in range(count):
+        yield first_userid + i // 1000, i % 1000 + 1, (i % 10 + 1) / 2
+
+
+class Suite:
+    def __init__(self, conn, filepath, rows, repeat):
+        self.conn = conn
+        self.filepath = filepath
+        self.rows = rows
+        self.repeat = repeat
+        self.results = {}
+        self.next_userid = rows // RATINGS_PER_USER + 10
+
+    def measure(self, name, func, setup=None, rows=None):
+        """
+        Chạy @func @repeat lần (sau @setup, không tính giờ) và ghi lại trung vị, cùng thời gian trung bình mỗi lần
+        chạy của từng pha do các hàm trong Interface báo qua metrics
+        """
+        runs = []
+        histogram = metrics.HistogramSink()
+        for _ in range(self.repeat):
+            if setup:
+                setup()
+            metrics.add_sink(histogram)
+            start = time.perf_counter()
+            try:
+                func()
+            finally:
+                runs.append(time.perf_counter() - start)
+                metrics.remove_sink(histogram)
+        seconds = statistics.median(runs)
+        result = {'seconds': seconds, 'runs': runs}
+        phases = {key: summary['total'] / self.repeat for key, summary in histogram.summary().items() if '.' in key}
+        if phases:
+            result['phases'] = phases
+        if rows:
+            result['rows'] = rows
+            result['rows_per_sec'] = rows / seconds
+        self.results[name] = result
+        print(f"{name:<28} {seconds:9.3f} s" + (f"  {rows / seconds:12.0f} rows/sec" if rows else ""))
+
+    def reset(self):
+        testHelper.deleteAllPublicTables(self.conn)
+        self.conn.commit()
+
+    def load(self):
+        MyAssignment.loadratings(RATINGS_TABLE, self.filepath, self.conn)
+
+    def measure_memory(self, name):
+        """Đo bộ nhớ của bộ nạp @name trong một tiến trình mới (spawn: không kế thừa bộ nhớ của tiến trình này)"""
+        self.reset()
+        with multiprocessing.get_context('spawn').Pool(1) as pool:
+            memory = pool.apply(load_memory, (name, self.filepath))
+        self.results[name].update(memory)
+        print(f"{name:<28} {memory['peak_alloc_mb']:9.1f} MB allocated, {memory['peak_rss_mb']:9.1f} MB RSS at peak")
+
+    def verify(self, prefix, n, **checks):
+        testHelper.testpartitioning(RATINGS_TABLE, n, self.conn, prefix, 0, self.rows, **checks)
+        self.conn.commit()
+
+    def inserts(self, insert, count):
+        rows = list(new_rows(count, self.next_userid))
+        self.next_userid += count // 1000 + 1
+
+        def run():
+            for userid, movieid, rating in rows:
+                insert(RATINGS_TABLE, userid, movieid, rating, self.conn)
+
+        return run
+
+    def batched_inserts(self, insert_many, count):
+        rows = list(new_rows(count, self.next_userid))
+        self.next_userid += count // 1000 + 1
+
+        def run():
+            for i in range(0, len(rows), BATCH_SIZE):
+                insert_many(RATINGS_TABLE, rows[i:i + BATCH_SIZE], self.conn)
+
+        return run
+
+    def run(self, partition_counts):
+        self.measure('load', self.load, setup=self.reset, rows=self.rows)
+        self.measure('load_stringio', lambda: stringio_loadratings(RATINGS_TABLE, self.filepath, self.conn),
+                     setup=self.reset, rows=self.rows)
+        for name in LOADERS:
+            self.measure_memory(name)
+        self.load()
+
+        for n in partition_counts:
+            self.measure(f'rangepartition_n{n}', lambda: MyAssignment.rangepartition(RATINGS_TABLE, n, self.conn),
+                         rows=self.rows)
+            self.measure(f'verify_range_n{n}',
+                         lambda: self.verify(testHelper.RANGE_TABLE_PREFIX, n,
+                                             conditions=testHelper.rangebandconditions(n)))
+            self.measure(f'roundrobinpartition_n{n}',
+                         lambda: MyAssignment.roundrobinpartition(RATINGS_TABLE, n, self.conn), rows=self.rows)
+            self.measure(f'verify_rrobin_n{n}',
+                         lambda: self.verify(testHelper.RROBIN_TABLE_PREFIX, n, roundrobin=True))
+
+        # Mỗi lần lặp chèn một bộ dòng mới, nên các kịch bản chèn tự sinh dữ liệu trong setup
+        for name, insert in (('rangeinsert', MyAssignment.rangeinsert),
+                             ('roundrobininsert', MyAssignment.roundrobininsert)):
+            runs = []
+            self.measure(f'{name}_single', lambda: runs.pop()(),
+                         setup=lambda: runs.append(self.inserts(insert, SINGLE_ROW_INSERTS)),
+                         rows=SINGLE_ROW_INSERTS)
+        for name, insert_many in (('rangeinsert_many', MyAssignment.rangeinsert_many),
+                                  ('roundrobininsert_many', MyAssignment.roundrobininsert_many)):
+            runs = []
+            self.measure(name, lambda: runs.pop()(),
+                         setup=lambda: runs.append(self.batched_inserts(insert_many, BATCHED_INSERTS)),
+                         rows=BATCHED_INSERTS)
+        return self.results
+
+
+def environment(conn, args) -> dict:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    with conn.cursor() as cur:
+        cur.execute("SHOW server_version;")
+        server_version = cur.fetchone()[0]
+    return {
+        'rows': args.rows,
+        'skew': args.skew,
+        'seed': args.seed,
+        'repeat': args.repeat,
+        'partition_counts': args.partitions,
+        'commit': commit,
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'postgres': server_version,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def run(args) -> int:
+    filepath = dataset(args.rows, args.skew, args.seed)
+    conn = MyAssignment.getopenconnection()
+    try:
+        report = {'environment': environment(conn, args)}
+        report['scenarios'] = Suite(conn, filepath, args.rows, args.repeat).run(args.partitions)
+    finally:
+        conn.close()
+        MyAssignment.close_connection_pool()
+
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.out}")
+    return 0
+
+
+def compare(args) -> int:
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+
+    for key in ('rows', 'skew', 'seed'):
+        if base['environment'].get(key) != new['environment'].get(key):
+            print(f"WARNING: runs differ in {key}: {base['environment'].get(key)} vs {new['environment'].get(key)}")
+
+    regressions = 0
+    for name, result in new['scenarios'].items():
+        if name not in base['scenarios']:
+            print(f"{name:<28} {'':>9}   {result['seconds']:9.3f} s  (new)")
+            continue
+        before, after = base['scenarios'][name]['seconds'], result['seconds']
+        change = after / before - 1 if before else 0.0
+        if change > args.threshold:
+            status = 'REGRESSION'
+            regressions += 1
+        elif change < -args.threshold:
+            status = 'improved'
+        else:
+            status = ''
+        print(f"{name:<28} {before:9.3f} s -> {after:9.3f} s  {change:+7.1%}  {status}")
+        if 'peak_alloc_mb' in result and 'peak_alloc_mb' in base['scenarios'][name]:
+            before, after = base['scenarios'][name]['peak_alloc_mb'], result['peak_alloc_mb']
+            change = after / before - 1 if before else 0.0
+            if change > args.threshold:
+                regressions += 1
+            print(f"{'':<28} {before:9.1f} MB -> {after:8.1f} MB {change:+7.1%}  "
+                  f"{'REGRESSION' if change > args.threshold else ''}")
+
+    print(f"{regressions} regression(s) above {args.threshold:.0%}")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Partitioning benchmark suite")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help="run every scenario and write the results as JSON")
+    run_parser.add_argument('--rows', type=parse_rows, default=parse_rows('1M'), help="dataset size, e.g. 1M, 10M, 50M")
+    run_parser.add_argument('--skew', type=float, default=1.0, help="Zipf exponent of the rating distribution")
+    run_parser.add_argument('--seed', type=int, default=42)
+    run_parser.add_argument('--repeat', type=int, default=3, help="runs per scenario; the median is reported")
+    run_parser.add_argument('--partitions', type=int, nargs='+', default=PARTITION_COUNTS)
+    run_parser.add_argument('--out', help="JSON file to write the results to")
+
+    compare_parser = commands.add_parser('compare', help="compare two result files and flag regressions")
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=0.10,
+                                help="relative slow-down counted as a regression (default 0.10)")
+
+    args = parser.parse_args()
+    sys.exit(run(args) if args.command == 'run' else compare(args))
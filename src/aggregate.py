@@ -0,0 +1,323 @@
+import abc
+import math
+from concurrent.futures import as_completed
+
+from . import metrics
+from .Interface import get_connection_pool, get_node_pool, uses_connection
+from .query import get_partition_readers, partition_tables
+
+# Thứ tự chọn cách phân mảnh khi không chỉ định: phân mảnh nào cũng chứa đủ mọi dòng của bảng gốc
+PARTITION_TYPES = ('range', 'rrobin', 'hash')
+
+
+class Aggregate(abc.ABC):
+    """
+    Một hàm gộp của aggregate(). Mỗi phân mảnh tính các biểu thức partials() cho từng nhóm; giá trị của mọi phân mảnh
+    được merge() gộp vào state (bắt đầu từ initial()) và finish() đổi state thành kết quả. Sketch đặt thêm @key, một
+    biểu thức GROUP BY phụ: partials tính theo (nhóm, key) và merge() nhận giá trị key. Tên cột được chèn nguyên vào SQL
+    """
+    key = None
+
+    def __init__(self, column=None):
+        self.column = column
+
+    @abc.abstractmethod
+    def partials(self) -> list[str]:
+        """Các biểu thức SQL tính trên từng phân mảnh cho mỗi nhóm"""
+
+    def initial(self):
+        return None
+
+    @abc.abstractmethod
+    def merge(self, state, key, values):
+        """Gộp @values (giá trị partials() của một phân mảnh) vào @state và trả về state mới"""
+
+    def finish(self, state):
+        return state
+
+
+class Count(Aggregate):
+    """count(*), hoặc count(@column) đếm các giá trị khác NULL"""
+
+    def partials(self):
+        return [f"count({self.column or '*'})"]
+
+    def initial(self):
+        return 0
+
+    def merge(self, state, key, values):
+        return state + values[0]
+
+
+class Sum(Aggregate):
+    def partials(self):
+        return [f"sum({self.column})"]
+
+    def merge(self, state, key, values):
+        # Phân mảnh không có giá trị nào cho nhóm trả về NULL
+        if values[0] is None:
+            return state
+        return values[0] if state is None else state + values[0]
+
+
+class Min(Aggregate):
+    def partials(self):
+        return [f"min({self.column})"]
+
+    def merge(self, state, key, values):
+        if values[0] is None:
+            return state
+        return values[0] if state is None else min(state, values[0])
+
+
+class Max(Aggregate):
+    def partials(self):
+        return [f"max({self.column})"]
+
+    def merge(self, state, key, values):
+        if values[0] is None:
+            return state
+        return values[0] if state is None else max(state, values[0])
+
+
+class Avg(Aggregate):
+    """Trung bình của @column, gộp dưới dạng (sum, count) để mỗi phân mảnh có trọng số theo số dòng"""
+
+    def partials(self):
+        return [f"sum({self.column})", f"count({self.column})"]
+
+    def initial(self):
+        return [None, 0]
+
+    def merge(self, state, key, values):
+        if values[1]:
+            state[0] = values[0] if state[0] is None else state[0] + values[0]
+            state[1] += values[1]
+        return state
+
+    def finish(self, state):
+        return state[0] / state[1] if state[1] else None
+
+
+class DistinctCount(Aggregate):
+    """
+    Số giá trị khác nhau xấp xỉ của @column (kiểu số) bằng HyperLogLog với 2^@precision thanh ghi (sai số chuẩn
+    tương đối khoảng 1.04 / sqrt(2^@precision), 1.6% với mặc định 12). Mỗi phân mảnh trả về rank lớn nhất của từng
+    thanh ghi, gộp bằng max theo thanh ghi. Hash 32 bit giữ ước lượng chính xác đến khoảng 10^8 giá trị
+    """
+
+    def __init__(self, column, precision=12):
+        if not 4 <= precision <= 16:
+            raise ValueError("HyperLogLog precision must be between 4 and 16")
+        super().__init__(column)
+        self.precision = precision
+        self.registers = 1 << precision
+        hash = f"hashfloat8(({column})::float8)"
+        self.key = f"({hash} & {self.registers - 1})"
+        # rank = số bit 0 đứng đầu của (32 - p) bit còn lại của hash, cộng 1. Với w > 0 đó là (32 - p) - floor(log2 w);
+        # log2(w + 0.5) tránh sai số làm tròn của ln tại đúng các luỹ thừa của 2
+        bits = 32 - precision
+        word = f"(({hash} >> {precision}) & {(1 << bits) - 1})"
+        log2 = f"ln({word}::float8 + 0.5) / {math.log(2)!r}"
+        self._rank = f"CASE WHEN {word} = 0 THEN {bits + 1} ELSE {bits} - floor({log2})::int END"
+
+    def partials(self):
+        return [f"max({self._rank})"]
+
+    def initial(self):
+        return bytearray(self.registers)
+
+    def merge(self, state, key, values):
+        if key is not None and values[0] > state[key]:
+            state[key] = values[0]
+        return state
+
+    def finish(self, state):
+        m = self.registers
+        alpha = 0.7213 / (1 + 1.079 / m) if m >= 128 else {16: 0.673, 32: 0.697, 64: 0.709}[m]
+        estimate = alpha * m * m / sum(2.0 ** -rank for rank in state)
+        zeros = state.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # Ít giá trị: linear counting trên số thanh ghi còn trống chính xác hơn
+            estimate = m * math.log(m / zeros)
+        return round(estimate)
+
+
+class Histogram(Aggregate):
+    """
+    Số dòng theo từng giá trị của @column, hoặc theo từng khoảng [k * @width, (k + 1) * @width) nếu có @width; không
+    có @width thì cột nhiều giá trị sẽ trả về nhiều dòng partial. Kết quả là dict sắp theo giá trị (cận dưới của
+    khoảng); không đếm NULL
+    """
+
+    def __init__(self, column, width=None):
+        super().__init__(column)
+        self.width = width
+        self.key = f"({column})" if width is None else f"(floor(({column}) / {float(width)!r}) * {float(width)!r})"
+
+    def partials(self):
+        return ["count(*)"]
+
+    def initial(self):
+        return {}
+
+    def merge(self, state, key, values):
+        if key is not None:
+            state[key] = state.get(key, 0) + values[0]
+        return state
+
+    def finish(self, state):
+        return dict(sorted(state.items()))
+
+
+class Quantiles(Histogram):
+    """
+    Các phân vị @quantiles (trong [0, 1]) của @column, đọc từ Histogram đã gộp: giống percentile_disc khi không có
+    @width, là cận dưới của khoảng chứa phân vị khi có @width. Trả về tuple
+    """
+
+    def __init__(self, column, quantiles=(0.5,), width=None):
+        super().__init__(column, width)
+        self.quantiles = tuple(quantiles)
+
+    def finish(self, state):
+        histogram = super().finish(state)
+        total = sum(histogram.values())
+        if not total:
+            return tuple(None for _ in self.quantiles)
+        results = []
+        for quantile in self.quantiles:
+            target, seen = max(1, math.ceil(quantile * total)), 0
+            for value, count in histogram.items():
+                seen += count
+                if seen >= target:
+                    results.append(value)
+                    break
+        return tuple(results)
+
+
+def partial_query(table, aggregates, groupby, where=None) -> tuple[str, list[str]]:
+    """
+    Truy vấn tính partials của @aggregates trên @table trong một lần quét, và các key của sketch. Có sketch thì nhóm
+    theo GROUPING SETS: (@groupby) cho hàm gộp thường và (@groupby, key) cho từng key, phân biệt bằng cột GROUPING()
+    đứng sau các cột key
+    """
+    keys = list(dict.fromkeys(aggregate.key for aggregate in aggregates if aggregate.key is not None))
+    columns = list(groupby) + keys
+    if keys:
+        columns.append(f"GROUPING({', '.join(keys)})")
+    columns += [expression for aggregate in aggregates for expression in aggregate.partials()]
+
+    query = f"SELECT {', '.join(columns)} FROM {table}"
+    if where:
+        query += f" WHERE {where}"
+    if keys:
+        sets = [f"({', '.join(groupby)})"] + [f"({', '.join([*groupby, key])})" for key in keys]
+        query += f" GROUP BY GROUPING SETS ({', '.join(sets)})"
+    elif groupby:
+        query += f" GROUP BY {', '.join(groupby)}"
+    return query, keys
+
+
+class PartialMerger:
+    """Gộp các dòng partial của partial_query() từ bất kỳ số phân mảnh nào, theo thứ tự bất kỳ, thành kết quả"""
+
+    def __init__(self, aggregates, groupby, keys):
+        self.aggregates = aggregates
+        self.groups = len(groupby)
+        self.states = {}
+        # GROUPING(k0, .., kK-1) có bit bằng 1 cho mỗi khoá không có trong tập nhóm; k0 là bit cao nhất
+        self.plain = (1 << len(keys)) - 1
+        self.sets = {self.plain ^ (1 << (len(keys) - 1 - j)): j for j in range(len(keys))}
+        self.keys = keys
+        self.slices = []
+        start = self.groups + len(keys) + (1 if keys else 0)
+        for aggregate in aggregates:
+            stop = start + len(aggregate.partials())
+            self.slices.append((start, stop))
+            start = stop
+
+    def add(self, rows) -> None:
+        for row in rows:
+            group = row[:self.groups]
+            states = self.states.get(group)
+            if states is None:
+                states = self.states[group] = [aggregate.initial() for aggregate in self.aggregates]
+            if self.keys:
+                grouping = row[self.groups + len(self.keys)]
+                key = None if grouping == self.plain else self.keys[self.sets[grouping]]
+            else:
+                key = None
+            value = row[self.groups + self.keys.index(key)] if key is not None else None
+            for i, aggregate in enumerate(self.aggregates):
+                if aggregate.key == key:
+                    start, stop = self.slices[i]
+                    states[i] = aggregate.merge(states[i], value, row[start:stop])
+
+    def result(self) -> list[tuple]:
+        groups = sorted(self.states, key=lambda group: [(value is None, value) for value in group])
+        return [(*group, *(aggregate.finish(state) for aggregate, state in zip(self.aggregates, self.states[group])))
+                for group in groups]
+
+
+@uses_connection
+@metrics.timed()
+def aggregate(ratingstablename, aggregates, groupby=(), where=None, params=(), partition_type=None,
+              openconnection=None) -> list[tuple]:
+    """
+    Tính @aggregates (Count, Sum, Min, Max, Avg, DistinctCount, Histogram, Quantiles) theo các cột @groupby trên các
+    dòng thoả @where (SQL, %s lấy từ @params). Partial được tính đồng thời trên mọi phân mảnh @partition_type, mỗi
+    phân mảnh một luồng đọc (giới hạn bởi pool kết nối), và gộp ngay khi về. Không có @partition_type thì dùng cách
+    chia đầu tiên có trong range, round robin, hash (hash trước nếu nhóm theo userid), hoặc bảng gốc. Trả về các
+    tuple (*nhóm, *kết quả) sắp theo nhóm
+    """
+    timer = metrics.current_timer()
+    aggregates, groupby = list(aggregates), list(groupby)
+
+    if partition_type:
+        candidates = [partition_type]
+    elif 'userid' in groupby:
+        # Mỗi userid chỉ nằm trong một phân mảnh hash: không có nhóm nào bị lặp lại giữa các phân mảnh
+        candidates = ['hash', *PARTITION_TYPES]
+    else:
+        candidates = PARTITION_TYPES
+    partitions = None
+    for candidate in candidates:
+        partitions = partition_tables(candidate, openconnection)
+        if partitions:
+            break
+    if partitions:
+        tables, nodes = partitions
+    elif partition_type:
+        raise ValueError(f"No partitions found with type '{partition_type}'")
+    else:
+        tables, nodes = [ratingstablename], [None]
+
+    query, keys = partial_query('{table}', aggregates, groupby, where)
+    merger = PartialMerger(aggregates, groupby, keys)
+
+    def read(table, node):
+        with (get_node_pool(node) if node else get_connection_pool()).connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(query.format(table=table), params)
+                rows = cursor.fetchall()
+            conn.rollback()
+        return rows
+
+    readers = get_partition_readers()
+    futures = [readers.submit(read, table, node) for table, node in zip(tables, nodes)]
+    partial_rows = 0
+    try:
+        for future in as_completed(futures):
+            rows = future.result()
+            partial_rows += len(rows)
+            with timer.phase('merge'):
+                merger.add(rows)
+    finally:
+        for future in futures:
+            future.cancel()
+
+    result = merger.result()
+    timer.rows = len(result)
+    timer.fields.update(partitions=len(tables), partial_rows=partial_rows)
+    return result
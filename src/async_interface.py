@@ -0,0 +1,746 @@
+import asyncio
+import functools
+import mmap
+import os
+
+import asyncpg
+
+from . import Interface, metrics, query
+from .Interface import (BULK_BUILD_SETTINGS, COPY_CHUNK_SIZE, DELETE_PARTITION_STATS, INSERT_PARTITION_STATS,
+                        INSERT_RATING, INSERT_RATING_IF_CURRENT, LOCK_RANGE_PARTITIONS, LOCK_RANGE_PARTITIONS_EXCLUSIVE,
+                        LOCK_RROBIN_SLOTS, LOCK_RROBIN_SLOTS_EXCLUSIVE, METADATA_CHANNEL, METADATA_SCHEMA_CURRENT,
+                        METADATA_TABLES, NOTIFY_PARTITION_METADATA, PARTITION_STATS_TABLE, PGCOPY_ROW,
+                        READ_PARTITION_METADATA, RESERVE_RROBIN_SLOTS, SAVE_PARTITION_METADATA, BinaryCopyStream,
+                        PartitionMetadata, PartitionStats, RatingsStream, add_partition_stats_commands,
+                        build_ratings_cache, cache_partition_metadata, cached_partition_metadata, connection_params,
+                        create_ratings_table_command, create_router_command, detach_router_command,
+                        equidepth_range_boundaries, fill_with_stats_command, finish_table_command, hash_partition_index,
+                        hash_slot_expression, invalidate_partition_metadata, logger, numbered_placeholders,
+                        partition_nodes, partition_stats_params, range_condition, range_partition_index,
+                        range_slot_expression, ratings_cache_path, restart_rrobin_slots_command, rrobin_slot_query,
+                        rrobin_slots_command, stats_by_slot, uniform_range_boundaries)
+from .query import overlapping_range_partitions
+
+#
+# asyncio counterpart of Interface: the same tables, metadata and partitioning schemes, on asyncpg. Every public
+# function is a coroutine taking an optional asyncpg `openconnection`; without one a connection is borrowed from
+# the shared AsyncConnectionPool, so thousands of concurrent inserts need no more than DB_POOL_MAX connections
+# and no thread per call. The SQL, the metadata cache and uses_connection are shared with Interface. Partitions
+# placed on several nodes are built, written and read by Interface in a worker thread, on its own pooled
+# connections, since only it runs distributed transactions. Call `await close_connection_pool()` before the
+# event loop ends.
+#
+
+RANGE_TABLE_PREFIX = 'range_part'
+RROBIN_TABLE_PREFIX = 'rrobin_part'
+HASH_TABLE_PREFIX = 'hash_part'
+
+
+def asyncpg_params(**overrides) -> dict:
+    """Tham số kết nối của Interface.connection_params theo tên mà asyncpg dùng"""
+    params = connection_params(**overrides)
+    params['database'] = params.pop('dbname')
+    return params
+
+
+async def rollback_if_in_transaction(openconnection: asyncpg.Connection) -> None:
+    """
+    Dọn kết nối trả về pool. Reset mặc định của asyncpg tốn một lượt gửi mỗi lần trả (RESET ALL, UNLISTEN, ...); như
+    Interface.ConnectionPool, chỉ rollback transaction còn dở vì các hàm ở đây chỉ dùng thiết lập cục bộ transaction
+    """
+    if openconnection.is_in_transaction():
+        await openconnection.execute("ROLLBACK;")
+
+
+class AsyncConnectionPool:
+    """
+    Pool asyncpg theo thiết lập trong .env, cùng một kết nối riêng LISTEN thay đổi metadata; kết nối trong pool không
+    giữ được việc đăng ký vì asyncpg bỏ các listener khi reset kết nối lúc trả về
+    """
+
+    def __init__(self, pool, listener):
+        self._pool = pool
+        self._listener = listener
+
+    @classmethod
+    async def create(cls, minconn, maxconn, **overrides):
+        params = asyncpg_params(**overrides)
+        pool = await asyncpg.create_pool(min_size=minconn, max_size=maxconn, reset=rollback_if_in_transaction,
+                                         **params)
+        try:
+            listener = await asyncpg.connect(**params)
+            await listener.add_listener(
+                METADATA_CHANNEL, lambda _conn, _pid, _channel, payload: invalidate_partition_metadata(payload or None)
+            )
+        except BaseException:
+            await pool.close()
+            raise
+        # Cache dùng chung với Interface: bỏ các mục có thể đã cũ trước khi kết nối này bắt đầu nhận NOTIFY
+        invalidate_partition_metadata()
+        return cls(pool, listener)
+
+    @property
+    def listening(self) -> bool:
+        return not self._listener.is_closed()
+
+    def connection(self):
+        """`async with pool.connection() as conn:` chờ đến khi có kết nối rảnh"""
+        return self._pool.acquire()
+
+    async def close(self) -> None:
+        await self._listener.close()
+        await self._pool.close()
+
+
+_connection_pool = None
+_connection_pool_task = None
+
+
+async def get_connection_pool() -> AsyncConnectionPool:
+    """Pool dùng chung của event loop hiện tại; kích thước lấy từ DB_POOL_MIN / DB_POOL_MAX trong .env"""
+    global _connection_pool, _connection_pool_task
+    if _connection_pool is not None:
+        return _connection_pool
+    # Các coroutine gọi đồng thời cùng chờ một lần tạo pool
+    if _connection_pool_task is None:
+        _connection_pool_task = asyncio.ensure_future(AsyncConnectionPool.create(
+            int(os.getenv('DB_POOL_MIN', 1)),
+            int(os.getenv('DB_POOL_MAX', 10))
+        ))
+    try:
+        _connection_pool = await _connection_pool_task
+    finally:
+        _connection_pool_task = None
+    return _connection_pool
+
+
+async def close_connection_pool() -> None:
+    global _connection_pool
+    pool, _connection_pool = _connection_pool, None
+    invalidate_partition_metadata()
+    if pool is not None:
+        await pool.close()
+
+
+# Interface.uses_connection, mượn kết nối từ pool asyncpg dùng chung
+uses_connection = functools.partial(Interface.uses_connection, pool=get_connection_pool)
+
+
+def affected_rows(status) -> int:
+    """Số dòng trong chuỗi trạng thái asyncpg trả về, ví dụ 'INSERT 0 42' hoặc 'COPY 42'"""
+    return int(status.rsplit(' ', 1)[-1])
+
+
+async def execute(openconnection: asyncpg.Connection, command, *params) -> str:
+    """Chạy một câu lệnh dùng chung của Interface (viết với %s); asyncpg tự PREPARE và cache nó trên mỗi kết nối"""
+    return await openconnection.execute(numbered_placeholders(command), *params)
+
+
+async def execute_fetchrow(openconnection: asyncpg.Connection, command, *params):
+    """Như execute, trả về dòng đầu tiên của kết quả"""
+    return await openconnection.fetchrow(numbered_placeholders(command), *params)
+
+
+async def ensure_metadata_tables(openconnection: asyncpg.Connection) -> None:
+    """Như Interface.ensure_metadata_tables: DDL chỉ chạy khi lược đồ còn thiếu, trong một transaction ngắn riêng"""
+    async with openconnection.transaction():
+        if not await openconnection.fetchval(METADATA_SCHEMA_CURRENT):
+            await openconnection.execute(METADATA_TABLES + PARTITION_STATS_TABLE)
+
+
+async def apply_bulk_build_settings(openconnection: asyncpg.Connection) -> None:
+    """BULK_BUILD_SETTINGS của Interface, chỉ trong transaction hiện tại nên kết nối trả về pool không giữ chúng"""
+    for name, value in BULK_BUILD_SETTINGS.items():
+        await openconnection.execute("SELECT set_config($1, $2, true);", name, value)
+
+
+async def save_partition_metadata(openconnection: asyncpg.Connection, partition_type, partition_count,
+                                  last_used=None, boundaries=None) -> None:
+    """Ghi (hoặc ghi đè) thông tin phân mảnh của @partition_type, như Interface.save_partition_metadata"""
+    await execute(openconnection, SAVE_PARTITION_METADATA, partition_type, partition_count, last_used, boundaries,
+                  None)
+    if partition_type == 'rrobin' and last_used is not None:
+        await openconnection.execute(restart_rrobin_slots_command(last_used + 1))
+
+    # NOTIFY chỉ được gửi khi transaction commit; cache dùng chung trong tiến trình được xoá ngay
+    await execute(openconnection, NOTIFY_PARTITION_METADATA, METADATA_CHANNEL, partition_type)
+    invalidate_partition_metadata(partition_type)
+
+
+async def save_partition_stats(openconnection: asyncpg.Connection, partition_type, stats) -> None:
+    """Ghi đè thống kê của mọi phân mảnh @partition_type, như Interface.save_partition_stats"""
+    await execute(openconnection, DELETE_PARTITION_STATS, partition_type, partition_type)
+    await openconnection.executemany(numbered_placeholders(INSERT_PARTITION_STATS),
+                                     partition_stats_params(partition_type, stats))
+
+
+async def add_partition_stats(openconnection: asyncpg.Connection, partition_type, added) -> None:
+    """Cộng các dòng vừa chèn vào thống kê của từng phân mảnh, như Interface.add_partition_stats"""
+    for _, command, params in add_partition_stats_commands(partition_type, added):
+        await execute(openconnection, command, *params)
+
+
+@uses_connection
+async def get_partition_metadata(partition_type, openconnection: asyncpg.Connection = None) -> PartitionMetadata | None:
+    """Metadata của @partition_type, lấy từ cache dùng chung với Interface khi kết nối LISTEN của pool đang đăng ký"""
+    listening = _connection_pool is not None and _connection_pool.listening
+    if listening:
+        cached = cached_partition_metadata(partition_type)
+        if cached:
+            return cached
+
+    row = await execute_fetchrow(openconnection, READ_PARTITION_METADATA, partition_type)
+    metadata = PartitionMetadata(partition_type, *row) if row else None
+    if metadata and listening:
+        cache_partition_metadata(metadata)
+    return metadata
+
+
+async def get_range_boundaries(openconnection: asyncpg.Connection) -> list[float] | None:
+    """Cận trên của các phân mảnh range hiện tại (từ cache metadata), None nếu chưa phân mảnh"""
+    metadata = await get_partition_metadata('range', openconnection)
+    if not metadata or not metadata.partition_count:
+        return None
+    return metadata.boundaries or uniform_range_boundaries(metadata.partition_count)
+
+
+async def read_chunks(read):
+    """Duyệt async các khối do @read (hàm chặn, chạy trong luồng riêng) trả về"""
+    while chunk := await asyncio.to_thread(read, COPY_CHUNK_SIZE):
+        yield chunk
+
+
+@uses_connection
+@metrics.timed('async_loadratings')
+async def loadratings(ratingstablename, ratingsfilepath, openconnection=None, cache=False, bulk=False) -> int:
+    """
+    Nạp ratings.dat vào @ratingstablename trong một transaction; file được đọc và chuyển đổi trong luồng riêng để
+    event loop vẫn phục vụ coroutine khác. @cache, @bulk như Interface.loadratings (thiết lập bulk chỉ trong
+    transaction). Trả về số dòng đã nạp
+    """
+    timer = metrics.current_timer()
+    timer.fields['bulk'] = bulk
+    async with openconnection.transaction():
+        with timer.phase('create'):
+            if bulk:
+                await apply_bulk_build_settings(openconnection)
+            await openconnection.execute(create_ratings_table_command(ratingstablename, bulk))
+
+        if cache:
+            cachepath = ratings_cache_path(ratingsfilepath)
+            timer.fields['cache'] = 'hit' if os.path.exists(cachepath) else 'miss'
+            if timer.fields['cache'] == 'miss':
+                with timer.phase('parse'):
+                    await asyncio.to_thread(build_ratings_cache, ratingsfilepath, cachepath)
+
+            with timer.phase('copy'), open(cachepath, 'rb') as f:
+                # Không thể mmap một file rỗng
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b''
+                try:
+                    rows = len(buffer) // PGCOPY_ROW.size
+                    await openconnection.copy_to_table(
+                        ratingstablename, source=read_chunks(BinaryCopyStream(buffer, 0, rows).read),
+                        columns=['userid', 'movieid', 'rating'], format='binary'
+                    )
+                finally:
+                    if isinstance(buffer, mmap.mmap):
+                        buffer.close()
+        else:
+            with timer.phase('copy'), open(ratingsfilepath, 'rb') as f:
+                stream = RatingsStream(f)
+                await openconnection.copy_to_table(
+                    ratingstablename, source=read_chunks(stream.read), columns=['userid', 'movieid', 'rating']
+                )
+                rows = stream.rows
+            timer.add_phase('parse', stream.parse_seconds)
+
+        with timer.phase('index'):
+            await openconnection.execute(finish_table_command(ratingstablename, bulk))
+
+    timer.rows = rows
+    return rows
+
+
+async def route_into_partitions(openconnection: asyncpg.Connection, tableprefix, numberofpartitions,
+                                sourcequery, bulk=False) -> tuple[int, list[PartitionStats]]:
+    """
+    Dựng trong một lần quét như Interface.route_into_partitions: @sourcequery trả về (userid, movieid, rating, slot),
+    bảng định tuyến LIST đưa mỗi dòng vào {tableprefix}{slot}. Trả về số dòng và thống kê từng phân mảnh
+    """
+    router = f"router_{tableprefix}"
+
+    with metrics.phase('create'):
+        await openconnection.execute(create_router_command(router, tableprefix, numberofpartitions, bulk))
+
+    with metrics.phase('fill'):
+        rows, stats = stats_by_slot(await openconnection.fetch(
+            fill_with_stats_command(router, "userid, movieid, rating, slot", sourcequery, 'slot')
+        ), numberofpartitions)
+
+    with metrics.phase('index'):
+        await openconnection.execute(detach_router_command(router, tableprefix, numberofpartitions, bulk))
+    return rows, stats
+
+
+async def drop_tables(openconnection: asyncpg.Connection, tablenames) -> None:
+    """Như Interface.drop_tables: chỉ để dọn dẹp, lỗi được ghi log để không che lỗi gốc"""
+    try:
+        await openconnection.execute("".join(f"DROP TABLE IF EXISTS {tablename};" for tablename in tablenames))
+    except (OSError, asyncpg.PostgresError):
+        logger.exception("Dropping %s failed", ", ".join(tablenames))
+
+
+async def fill_partitions_concurrently(tableprefix, numberofpartitions, partitionquery, workers,
+                                      bulk=False) -> tuple[int, list[PartitionStats]]:
+    """
+    Tạo và đổ {tableprefix}0 .. N-1 bằng asyncio.gather, mỗi phân mảnh một transaction trên kết nối của pool, tối đa
+    @workers cùng lúc; @partitionquery(i) là SELECT (userid, movieid, rating) của phân mảnh i. Một phân mảnh lỗi thì
+    xoá hết rồi ném lại lỗi. Trả về tổng số dòng và thống kê từng phân mảnh
+    """
+    pool = await get_connection_pool()
+    slots = asyncio.Semaphore(workers)
+
+    async def fill(i):
+        async with slots, pool.connection() as conn, conn.transaction():
+            if bulk:
+                await apply_bulk_build_settings(conn)
+            await conn.execute(create_ratings_table_command(f"{tableprefix}{i}", bulk))
+            rows, stats = stats_by_slot(await conn.fetch(
+                fill_with_stats_command(f"{tableprefix}{i}", "userid, movieid, rating", partitionquery(i))
+            ), 1)
+            await conn.execute(finish_table_command(f"{tableprefix}{i}", bulk))
+            return rows, stats[0]
+
+    with metrics.phase('fill'):
+        results = await asyncio.gather(*(fill(i) for i in range(numberofpartitions)), return_exceptions=True)
+    errors = [result for result in results if isinstance(result, BaseException)]
+    if errors:
+        async with pool.connection() as conn:
+            await drop_tables(conn, [f"{tableprefix}{i}" for i in range(numberofpartitions)])
+        raise errors[0]
+    return sum(rows for rows, _ in results), [stats for _, stats in results]
+
+
+def drop_stale_node_partitions(tableprefix, previous: PartitionMetadata, numberofpartitions) -> None:
+    """Xoá các phân mảnh cũ còn nằm trên các nút sau khi dựng lại trên coordinator (Interface.drop_stale_partitions)"""
+    with Interface.get_connection_pool().connection() as conn:
+        Interface.drop_stale_partitions(conn, tableprefix, previous, numberofpartitions, None)
+
+
+async def build_partitions(openconnection: asyncpg.Connection, partition_type, numberofpartitions, sourcequery,
+                           partitionquery, workers, bulk, boundaries=None) -> int:
+    """
+    Phần chung của các hàm dựng: tạo {partition_type}_part0 .. N-1 trong một lần quét @sourcequery, hoặc song song từ
+    @partitionquery(i) khi @workers > 1, rồi ghi metadata và thống kê cùng transaction. Bước sau lỗi thì xoá lại các
+    phân mảnh worker đã commit. Trả về số dòng đã ghi
+    """
+    tableprefix = f"{partition_type}_part"
+    await ensure_metadata_tables(openconnection)
+    row = await execute_fetchrow(openconnection, READ_PARTITION_METADATA, partition_type)
+    previous = PartitionMetadata(partition_type, *row) if row else None
+
+    filled = False
+    try:
+        async with openconnection.transaction():
+            if partition_type in ('range', 'rrobin'):
+                # Các lệnh chèn range/round-robin chờ đến khi dựng xong
+                await openconnection.execute(LOCK_RANGE_PARTITIONS_EXCLUSIVE if partition_type == 'range'
+                                             else LOCK_RROBIN_SLOTS_EXCLUSIVE)
+            if bulk:
+                await apply_bulk_build_settings(openconnection)
+            if workers > 1:
+                rows, stats = await fill_partitions_concurrently(tableprefix, numberofpartitions, partitionquery,
+                                                                 workers, bulk)
+                filled = True
+            else:
+                rows, stats = await route_into_partitions(openconnection, tableprefix, numberofpartitions,
+                                                          sourcequery, bulk)
+            # last_used lưu số thứ tự (bắt đầu từ 0) của dòng cuối cùng đã được phân mảnh round-robin; vòng tiếp tục
+            # từ sequence
+            await save_partition_metadata(openconnection, partition_type, numberofpartitions,
+                                          rows - 1 if partition_type == 'rrobin' else None, boundaries)
+            await save_partition_stats(openconnection, partition_type, stats)
+    except BaseException:
+        if filled:
+            await drop_tables(openconnection, [f"{tableprefix}{i}" for i in range(numberofpartitions)])
+        raise
+
+    if previous and previous.nodes:
+        await asyncio.to_thread(drop_stale_node_partitions, tableprefix, previous, numberofpartitions)
+    return rows
+
+
+@uses_connection
+@metrics.timed('async_rangepartition')
+async def rangepartition(ratingstablename, numberofpartitions, openconnection=None, workers=1, adaptive=False,
+                         bulk=False, nodes=None):
+    """
+    Chia @ratingstablename thành range_part0 .. N-1 theo khoảng rating như Interface.rangepartition. @workers > 1: đổ
+    song song trên các kết nối của pool. @nodes (mặc định PARTITION_NODES): đặt phân mảnh qua Interface.rangepartition
+    """
+    if numberofpartitions <= 0:
+        raise ValueError("Number of partitions must be positive")
+    nodes = partition_nodes(nodes)
+    if nodes:
+        return await asyncio.to_thread(Interface.rangepartition, ratingstablename, numberofpartitions,
+                                       workers=workers, bulk=bulk, adaptive=adaptive, nodes=nodes)
+
+    timer = metrics.current_timer()
+    timer.fields.update(partitions=numberofpartitions, workers=workers, bulk=bulk)
+
+    if adaptive:
+        with timer.phase('histogram'):
+            histogram = await openconnection.fetch(
+                f"SELECT rating, COUNT(*) FROM {ratingstablename} GROUP BY rating ORDER BY rating;"
+            )
+            boundaries = equidepth_range_boundaries([tuple(row) for row in histogram], numberofpartitions)
+    else:
+        boundaries = uniform_range_boundaries(numberofpartitions)
+
+    timer.rows = await build_partitions(
+        openconnection,
+        'range',
+        numberofpartitions,
+        f"SELECT userid, movieid, rating, {range_slot_expression(boundaries)} FROM {ratingstablename}",
+        lambda i: f"SELECT userid, movieid, rating FROM {ratingstablename} WHERE {range_condition(i, boundaries)}",
+        workers,
+        bulk,
+        boundaries
+    )
+    timer.fields['boundaries'] = boundaries
+
+
+@uses_connection
+@metrics.timed('async_roundrobinpartition')
+async def roundrobinpartition(ratingstablename, numberofpartitions, openconnection=None, workers=1, bulk=False,
+                              nodes=None):
+    """
+    Chia @ratingstablename thành rrobin_part0 .. N-1 theo thứ tự dòng như Interface.roundrobinpartition; @workers,
+    @bulk, @nodes như rangepartition. @workers > 1: đánh số dòng một lần (Interface.number_rrobin_rows) để mọi kết
+    nối thấy cùng số thứ tự
+    """
+    if numberofpartitions <= 0:
+        raise ValueError("Number of partitions must be positive")
+    nodes = partition_nodes(nodes)
+    if nodes:
+        return await asyncio.to_thread(Interface.roundrobinpartition, ratingstablename, numberofpartitions,
+                                       workers=workers, bulk=bulk, nodes=nodes)
+
+    timer = metrics.current_timer()
+    timer.fields.update(partitions=numberofpartitions, workers=workers, bulk=bulk)
+
+    slots = None
+    try:
+        if workers > 1:
+            # Chạy ngoài transaction để các kết nối của worker đọc được bảng slots
+            slots, command = rrobin_slots_command(ratingstablename, numberofpartitions)
+            await openconnection.execute(command)
+        timer.rows = await build_partitions(
+            openconnection,
+            'rrobin',
+            numberofpartitions,
+            f"""
+                SELECT userid, movieid, rating, mod(row_number() over () - 1, {numberofpartitions})
+                FROM {ratingstablename}
+            """,
+            lambda i: rrobin_slot_query(slots, i),
+            workers,
+            bulk
+        )
+    finally:
+        if slots:
+            await drop_tables(openconnection, [slots])
+
+
+@uses_connection
+@metrics.timed('async_hashpartition')
+async def hashpartition(ratingstablename, numberofpartitions, openconnection=None, workers=1, bulk=False,
+                        nodes=None):
+    """
+    Chia @ratingstablename thành hash_part0 .. N-1 theo userid như Interface.hashpartition; @workers, @bulk, @nodes
+    như rangepartition
+    """
+    if numberofpartitions <= 0:
+        raise ValueError("Number of partitions must be positive")
+    nodes = partition_nodes(nodes)
+    if nodes:
+        return await asyncio.to_thread(Interface.hashpartition, ratingstablename, numberofpartitions,
+                                       workers=workers, bulk=bulk, nodes=nodes)
+
+    timer = metrics.current_timer()
+    timer.fields.update(partitions=numberofpartitions, workers=workers, bulk=bulk)
+    timer.rows = await build_partitions(
+        openconnection,
+        'hash',
+        numberofpartitions,
+        f"SELECT userid, movieid, rating, {hash_slot_expression(numberofpartitions)} FROM {ratingstablename}",
+        lambda i: f"""
+            SELECT userid, movieid, rating
+            FROM {ratingstablename}
+            WHERE {hash_slot_expression(numberofpartitions)} = {i}
+        """,
+        workers,
+        bulk
+    )
+
+
+async def placed_on_nodes(partition_type, openconnection: asyncpg.Connection) -> bool:
+    """Các phân mảnh @partition_type có nằm trên nhiều nút không; khi đó thao tác đi qua Interface"""
+    metadata = await get_partition_metadata(partition_type, openconnection)
+    return bool(metadata and metadata.nodes)
+
+
+async def reserve_rrobin_slots(openconnection: asyncpg.Connection, count) -> tuple[int, list[int]]:
+    """Như Interface.reserve_rrobin_slots: giữ @count vị trí round-robin, trả về (số phân mảnh, các vị trí)"""
+    await openconnection.execute(LOCK_RROBIN_SLOTS)
+    row = await execute_fetchrow(openconnection, RESERVE_RROBIN_SLOTS, count)
+    if not row:
+        raise ValueError("No round-robin partitions found")
+    numberofpartitions, nodes, slots = row
+    if nodes:
+        # Phân mảnh vừa được đặt lên các nút: transaction bị huỷ, lần gọi sau đi qua Interface
+        invalidate_partition_metadata('rrobin')
+        raise ValueError("The round-robin partitions were moved to several nodes; retry")
+    return numberofpartitions, slots
+
+
+@uses_connection
+@metrics.timed('async_roundrobininsert')
+async def roundrobininsert(ratingstablename, userid, itemid, rating, openconnection=None):
+    if await placed_on_nodes('rrobin', openconnection):
+        return await asyncio.to_thread(Interface.roundrobininsert, ratingstablename, userid, itemid, rating)
+
+    async with openconnection.transaction():
+        numberofpartitions, slots = await reserve_rrobin_slots(openconnection, 1)
+        index = slots[0] % numberofpartitions
+        for table_name in (ratingstablename, f"{RROBIN_TABLE_PREFIX}{index}"):
+            await execute(openconnection, INSERT_RATING.format(tablename=table_name), userid, itemid, float(rating))
+        await add_partition_stats(openconnection, 'rrobin', {index: PartitionStats.of([rating])})
+    metrics.current_timer().fields['partition'] = index
+
+
+@uses_connection
+@metrics.timed('async_roundrobininsert_many')
+async def roundrobininsert_many(ratingstablename, rows, openconnection=None) -> int:
+    """Chèn theo lô như Interface.roundrobininsert_many; trả về số dòng"""
+    rows = [(userid, movieid, float(rating)) for userid, movieid, rating in rows]
+    if not rows:
+        return 0
+    if await placed_on_nodes('rrobin', openconnection):
+        return await asyncio.to_thread(Interface.roundrobininsert_many, ratingstablename, rows)
+
+    timer = metrics.current_timer()
+    async with openconnection.transaction():
+        numberofpartitions, slots = await reserve_rrobin_slots(openconnection, len(rows))
+        groups = {}
+        for slot, row in zip(slots, rows):
+            groups.setdefault(slot % numberofpartitions, []).append(row)
+
+        with timer.phase('copy'):
+            await openconnection.copy_records_to_table(
+                ratingstablename, records=rows, columns=['userid', 'movieid', 'rating']
+            )
+            for index, group in groups.items():
+                await openconnection.copy_records_to_table(
+                    f"{RROBIN_TABLE_PREFIX}{index}", records=group, columns=['userid', 'movieid', 'rating']
+                )
+        with timer.phase('stats'):
+            await add_partition_stats(openconnection, 'rrobin', {index: PartitionStats.of(row[2] for row in group)
+                                                                 for index, group in groups.items()})
+    timer.rows = len(rows)
+    return len(rows)
+
+
+@uses_connection
+@metrics.timed('async_rangeinsert')
+async def rangeinsert(ratingstablename, userid, itemid, rating, openconnection: asyncpg.Connection = None) -> None:
+    """
+    Chèn một dòng chỉ vào phân mảnh range của @rating, như Interface.rangeinsert: dưới khoá advisory chung, dòng chỉ
+    được ghi nếu metadata đã dùng để định tuyến vẫn là phiên bản hiện tại, nếu không thì định tuyến lại
+    """
+    try:
+        for _ in range(3):
+            metadata = await get_partition_metadata('range', openconnection)
+            if not metadata or not metadata.partition_count:
+                raise Exception("No partitions found with type 'range'")
+            if metadata.nodes:
+                return await asyncio.to_thread(Interface.rangeinsert, ratingstablename, userid, itemid, rating)
+            boundaries = metadata.boundaries or uniform_range_boundaries(metadata.partition_count)
+            idx = range_partition_index(rating, boundaries)
+
+            try:
+                async with openconnection.transaction():
+                    await openconnection.execute(LOCK_RANGE_PARTITIONS)
+                    status = await execute(openconnection,
+                                           INSERT_RATING_IF_CURRENT.format(tablename=f"{RANGE_TABLE_PREFIX}{idx}"),
+                                           userid, itemid, float(rating), metadata.version)
+                    if affected_rows(status):
+                        await add_partition_stats(openconnection, 'range', {idx: PartitionStats.of([rating])})
+            except asyncpg.exceptions.UndefinedTableError:
+                # Phân mảnh trong cache đã bị gộp mất: định tuyến lại như khi phiên bản đã đổi
+                invalidate_partition_metadata('range')
+                continue
+            if affected_rows(status):
+                break
+            invalidate_partition_metadata('range')
+        else:
+            raise Exception("Range partitions kept changing while inserting")
+        metrics.current_timer().fields['partition'] = idx
+    except Exception as e:
+        raise Exception(f"[rangeinsert] Error: {e}")
+
+
+@uses_connection
+@metrics.timed('async_rangeinsert_many')
+async def rangeinsert_many(ratingstablename, rows, openconnection: asyncpg.Connection = None) -> int:
+    """Bản chèn theo lô của rangeinsert, như Interface.rangeinsert_many. Trả về số dòng"""
+    rows = [(userid, movieid, float(rating)) for userid, movieid, rating in rows]
+    timer = metrics.current_timer()
+    try:
+        if await placed_on_nodes('range', openconnection):
+            return await asyncio.to_thread(Interface.rangeinsert_many, ratingstablename, rows)
+
+        async with openconnection.transaction():
+            # Metadata đọc một lần cho cả lô, sau khoá advisory chung
+            await openconnection.execute(LOCK_RANGE_PARTITIONS)
+            row = await execute_fetchrow(openconnection, READ_PARTITION_METADATA, 'range')
+            if not row or not row[0]:
+                raise Exception("No partitions found with type 'range'")
+            metadata = PartitionMetadata('range', *row)
+            if metadata.nodes:
+                # Phân mảnh vừa được đặt lên các nút: transaction bị huỷ, lần gọi sau đi qua Interface
+                invalidate_partition_metadata('range')
+                raise ValueError("The range partitions were moved to several nodes; retry")
+            boundaries = metadata.boundaries or uniform_range_boundaries(metadata.partition_count)
+
+            groups = {}
+            for row in rows:
+                groups.setdefault(range_partition_index(row[2], boundaries), []).append(row)
+
+            with timer.phase('copy'):
+                for idx, group in groups.items():
+                    await openconnection.copy_records_to_table(
+                        f"{RANGE_TABLE_PREFIX}{idx}", records=group, columns=['userid', 'movieid', 'rating']
+                    )
+            with timer.phase('stats'):
+                await add_partition_stats(openconnection, 'range', {
+                    idx: PartitionStats.of(row[2] for row in group) for idx, group in groups.items()
+                })
+
+        timer.rows = len(rows)
+        timer.fields['partitions'] = len(groups)
+        return len(rows)
+    except Exception as e:
+        raise Exception(f"[rangeinsert_many] Error: {e}")
+
+
+@uses_connection
+@metrics.timed('async_hashinsert')
+async def hashinsert(ratingstablename, userid, itemid, rating, openconnection=None):
+    """Chèn dòng mới vào @ratingstablename và phân mảnh hash chứa @userid"""
+    metadata = await get_partition_metadata('hash', openconnection)
+    if not metadata or not metadata.partition_count:
+        raise ValueError("No hash partitions found")
+    if metadata.nodes:
+        return await asyncio.to_thread(Interface.hashinsert, ratingstablename, userid, itemid, rating)
+
+    index = hash_partition_index(userid, metadata.partition_count)
+    async with openconnection.transaction():
+        for table_name in (ratingstablename, f"{HASH_TABLE_PREFIX}{index}"):
+            await execute(openconnection, INSERT_RATING.format(tablename=table_name), userid, itemid, float(rating))
+        await add_partition_stats(openconnection, 'hash', {index: PartitionStats.of([rating])})
+    metrics.current_timer().fields['partition'] = index
+
+
+async def scheme_metadata(openconnection, *partition_types) -> PartitionMetadata | None:
+    """Metadata của cách phân mảnh đầu tiên trong @partition_types đã được phân mảnh, None nếu không có"""
+    for partition_type in partition_types:
+        metadata = await get_partition_metadata(partition_type, openconnection)
+        if metadata and metadata.partition_count:
+            return metadata
+    return None
+
+
+def partition_tables(metadata: PartitionMetadata | None, ratingstablename) -> list[str]:
+    if not metadata:
+        return [ratingstablename]
+    return [f"{metadata.partition_type}_part{i}" for i in range(metadata.partition_count)]
+
+
+async def query_nodes(function, *args) -> list[tuple]:
+    """Phân mảnh nằm trên nhiều nút: chạy truy vấn @function của module query (qua pool của từng nút) trong một luồng"""
+    return await asyncio.to_thread(lambda: [tuple(row) for row in function(*args)])
+
+
+async def fetch_partitions(tables, query, *params, partitions_total=None) -> list[tuple]:
+    """
+    Chạy @query (có chỗ {table}) đồng thời trên mọi bảng @tables bằng asyncio.gather, mỗi bảng một kết nối của pool;
+    trả về mọi dòng dạng (userid, movieid, rating)
+    """
+    pool = await get_connection_pool()
+
+    async def fetch(table):
+        async with pool.connection() as conn:
+            return await conn.fetch(query.format(table=table), *params)
+
+    with metrics.timer('async_query', partitions=len(tables), partitions_total=partitions_total or len(tables)) as timer:
+        results = await asyncio.gather(*(fetch(table) for table in tables))
+        rows = [tuple(row) for result in results for row in result]
+        timer.rows = len(rows)
+    return rows
+
+
+async def rangequery(ratingstablename, ratingminvalue, ratingmaxvalue, openconnection=None) -> list[tuple]:
+    """
+    Các dòng có @ratingminvalue <= rating <= @ratingmaxvalue, lọc phân mảnh và fan-out như query.rangequery.
+    @openconnection chỉ dùng để tra metadata; các phân mảnh được đọc trên kết nối riêng của pool
+    """
+    sql = "SELECT userid, movieid, rating FROM {table} WHERE rating >= $1 AND rating <= $2"
+
+    metadata = await scheme_metadata(openconnection, 'range', 'rrobin')
+    if metadata and metadata.nodes:
+        return await query_nodes(query.rangequery, ratingstablename, ratingminvalue, ratingmaxvalue)
+    if metadata and metadata.partition_type == 'range':
+        boundaries = metadata.boundaries or uniform_range_boundaries(metadata.partition_count)
+        tables = [f"{RANGE_TABLE_PREFIX}{i}"
+                  for i in overlapping_range_partitions(boundaries, ratingminvalue, ratingmaxvalue)]
+        return await fetch_partitions(tables, sql, ratingminvalue, ratingmaxvalue, partitions_total=len(boundaries))
+    return await fetch_partitions(partition_tables(metadata, ratingstablename), sql, ratingminvalue, ratingmaxvalue)
+
+
+@uses_connection
+async def pointquery(ratingstablename, userid, movieid, openconnection=None) -> list[tuple]:
+    """
+    Rating của (@userid, @movieid) nếu có: chỉ dò phân mảnh hash chứa @userid nếu có, ngược lại dò khoá chính của
+    mọi phân mảnh trong một UNION ALL, như query.pointquery
+    """
+    metadata = await scheme_metadata(openconnection, 'hash', 'range', 'rrobin')
+    if metadata and metadata.nodes:
+        return await query_nodes(query.pointquery, ratingstablename, userid, movieid)
+    if metadata and metadata.partition_type == 'hash':
+        tables = [f"{HASH_TABLE_PREFIX}{hash_partition_index(userid, metadata.partition_count)}"]
+    else:
+        tables = partition_tables(metadata, ratingstablename)
+    sql = " UNION ALL ".join(
+        f"SELECT userid, movieid, rating FROM {table} WHERE userid = $1 AND movieid = $2" for table in tables
+    )
+    with metrics.timer('async_query', partitions=len(tables)) as timer:
+        rows = [tuple(row) for row in await openconnection.fetch(sql, userid, movieid)]
+        timer.rows = len(rows)
+    return rows
+
+
+async def userquery(ratingstablename, userid, openconnection=None) -> list[tuple]:
+    """
+    Mọi rating của @userid: một phân mảnh hash, hoặc fan-out qua các phân mảnh range / round robin. @openconnection
+    chỉ dùng để tra metadata; các phân mảnh được đọc trên kết nối riêng của pool
+    """
+    sql = "SELECT userid, movieid, rating FROM {table} WHERE userid = $1"
+
+    metadata = await scheme_metadata(openconnection, 'hash', 'range', 'rrobin')
+    if metadata and metadata.nodes:
+        return await query_nodes(query.userquery, ratingstablename, userid)
+    if metadata and metadata.partition_type == 'hash':
+        table = f"{HASH_TABLE_PREFIX}{hash_partition_index(userid, metadata.partition_count)}"
+        return await fetch_partitions([table], sql, userid, partitions_total=metadata.partition_count)
+    return await fetch_partitions(partition_tables(metadata, ratingstablename), sql, userid)
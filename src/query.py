@@ -0,0 +1,223 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from . import metrics
+from .Interface import (get_connection_pool, get_node_pool, get_partition_metadata, hash_partition_index,
+                        uniform_range_boundaries, uses_connection)
+
+# Số dòng mỗi lần fetch từ server-side cursor của một phân mảnh
+FETCH_SIZE = 10000
+# Số lô dòng tối đa chờ trong hàng đợi trước khi các luồng đọc phải đợi người dùng tiêu thụ bớt
+QUEUE_BATCHES = 64
+
+_DONE = object()
+
+_partition_readers = None
+_partition_readers_lock = threading.Lock()
+
+
+def get_partition_readers() -> ThreadPoolExecutor:
+    """
+    Các luồng đọc dùng chung cho mọi truy vấn, tạo ở lần truy vấn đầu thay vì lúc import; số luồng bằng kích thước
+    tối đa của pool kết nối
+    """
+    global _partition_readers
+    with _partition_readers_lock:
+        if _partition_readers is None:
+            _partition_readers = ThreadPoolExecutor(max_workers=int(os.getenv('DB_POOL_MAX', 10)),
+                                                    thread_name_prefix='partition-reader')
+        return _partition_readers
+
+
+class QueryResult:
+    """
+    Các dòng của một truy vấn fan-out, trả về dần khi từng phân mảnh gửi tới. Khi duyệt, mỗi phân mảnh có một luồng
+    đọc (giới hạn bởi pool kết nối); duyệt hết thì @elapsed là thời gian thực. @partitions là các bảng thực sự được
+    quét, @partitions_total là số phân mảnh của cách chia. @fanout=False: gửi một UNION ALL qua một kết nối (mỗi
+    nút), rẻ hơn khi mỗi truy vấn chỉ là một lần dò index. @nodes: DSN nút của từng bảng (None: database điều phối)
+    """
+
+    def __init__(self, tables, query, params, partitions_total, fanout=True, nodes=None):
+        self.partitions = tables
+        self.partitions_total = partitions_total
+        self.rows = 0
+        self.elapsed = None
+        self._query = query
+        self._params = params
+        self._fanout = fanout
+        self._nodes = nodes or [None] * len(tables)
+
+    def __iter__(self):
+        if not self._fanout:
+            yield from self._single_round_trip()
+            return
+
+        start_time = time.time()
+        batches = queue.Queue(maxsize=QUEUE_BATCHES)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def read(table, node):
+            try:
+                with (get_node_pool(node) if node else get_connection_pool()).connection() as conn:
+                    with conn.cursor(name=f"scan_{table}") as cursor:
+                        cursor.execute(self._query.format(table=table), self._params)
+                        while not stop.is_set():
+                            rows = cursor.fetchmany(FETCH_SIZE)
+                            if not rows:
+                                break
+                            put(rows)
+                    conn.rollback()
+                put(_DONE)
+            except Exception as e:
+                put(e)
+
+        readers = get_partition_readers()
+        futures = [readers.submit(read, table, node) for table, node in zip(self.partitions, self._nodes)]
+        try:
+            remaining = len(self.partitions)
+            while remaining:
+                item = batches.get()
+                if item is _DONE:
+                    remaining -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    self.rows += len(item)
+                    yield from item
+            self.elapsed = time.time() - start_time
+            self._emit()
+        finally:
+            stop.set()
+            wait(futures)
+
+    def _single_round_trip(self):
+        start_time = time.time()
+        groups = {}
+        for table, node in zip(self.partitions, self._nodes):
+            groups.setdefault(node, []).append(table)
+        rows = []
+        for node, tables in groups.items():
+            query = " UNION ALL ".join(self._query.format(table=table) for table in tables)
+            with (get_node_pool(node) if node else get_connection_pool()).connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(query, self._params * len(tables))
+                    rows += cursor.fetchall()
+                conn.rollback()
+        self.rows = len(rows)
+        self.elapsed = time.time() - start_time
+        self._emit()
+        yield from rows
+
+    def _emit(self):
+        # Kết quả được đọc dần nên không dùng metrics.timer (contextvar không đi theo generator qua các lần yield)
+        timer = metrics.Timer('query', partitions=len(self.partitions), partitions_total=self.partitions_total)
+        timer.seconds = self.elapsed
+        timer.rows = self.rows
+        metrics.emit(timer.record())
+
+
+def partition_tables(partition_type, openconnection, indexes=None):
+    """(bảng, nút) của các phân mảnh @partition_type (chỉ @indexes nếu truyền), None nếu không có phân mảnh"""
+    metadata = get_partition_metadata(partition_type, openconnection)
+    if not metadata or not metadata.partition_count:
+        return None
+    if indexes is None:
+        indexes = range(metadata.partition_count)
+    return [f"{partition_type}_part{i}" for i in indexes], [metadata.node(i) for i in indexes]
+
+
+def _hash_partition_table(userid, openconnection):
+    """(bảng, nút) của phân mảnh hash chứa @userid và số phân mảnh hash, None nếu chưa phân mảnh theo hash"""
+    metadata = get_partition_metadata('hash', openconnection)
+    if not metadata or not metadata.partition_count:
+        return None, 0
+    index = hash_partition_index(userid, metadata.partition_count)
+    return ([f"hash_part{index}"], [metadata.node(index)]), metadata.partition_count
+
+
+def overlapping_range_partitions(boundaries, ratingminvalue, ratingmaxvalue) -> list[int]:
+    """Số thứ tự các phân mảnh range có khoảng có thể chứa rating trong [@ratingminvalue, @ratingmaxvalue]"""
+    indexes = []
+    last = len(boundaries) - 1
+    for i, upper in enumerate(boundaries):
+        # Phân mảnh i chứa (boundaries[i - 1], upper]; phân mảnh đầu và cuối nhận cả rating ngoài [0, 5]
+        if (i == last or ratingminvalue <= upper) and (i == 0 or ratingmaxvalue > boundaries[i - 1]):
+            indexes.append(i)
+    return indexes
+
+
+@uses_connection
+def rangequery(ratingstablename, ratingminvalue, ratingmaxvalue, openconnection=None) -> QueryResult:
+    """
+    Các dòng có @ratingminvalue <= rating <= @ratingmaxvalue. Bỏ qua các phân mảnh range có khoảng (theo cận đã lưu)
+    không giao khoảng cần tìm; không có phân mảnh range thì quét mọi phân mảnh round robin, không có cả hai thì quét
+    bảng gốc
+    """
+    query = "SELECT userid, movieid, rating FROM {table} WHERE rating >= %s AND rating <= %s"
+    params = (ratingminvalue, ratingmaxvalue)
+
+    metadata = get_partition_metadata('range', openconnection)
+    if metadata and metadata.partition_count:
+        boundaries = metadata.boundaries or uniform_range_boundaries(metadata.partition_count)
+        indexes = overlapping_range_partitions(boundaries, ratingminvalue, ratingmaxvalue)
+        tables, nodes = partition_tables('range', openconnection, indexes)
+        return QueryResult(tables, query, params, len(boundaries), nodes=nodes)
+
+    partitions = partition_tables('rrobin', openconnection)
+    if partitions:
+        tables, nodes = partitions
+        return QueryResult(tables, query, params, len(tables), nodes=nodes)
+    return QueryResult([ratingstablename], query, params, 1)
+
+
+@uses_connection
+def pointquery(ratingstablename, userid, movieid, openconnection=None) -> QueryResult:
+    """
+    Rating của (@userid, @movieid) nếu có. Có phân mảnh hash thì chỉ dò phân mảnh chứa @userid. Ngược lại cách chia
+    range và round robin không phụ thuộc khoá nên dò mọi phân mảnh qua khoá chính, gửi chung một lượt thay vì
+    fan-out vì chuyển việc qua luồng còn tốn hơn chính các lần dò
+    """
+    query = "SELECT userid, movieid, rating FROM {table} WHERE userid = %s AND movieid = %s"
+    params = (userid, movieid)
+
+    partition, partitions_total = _hash_partition_table(userid, openconnection)
+    if partition:
+        return QueryResult(partition[0], query, params, partitions_total, fanout=False, nodes=partition[1])
+
+    for partition_type in ('range', 'rrobin'):
+        partitions = partition_tables(partition_type, openconnection)
+        if partitions:
+            tables, nodes = partitions
+            return QueryResult(tables, query, params, len(tables), fanout=False, nodes=nodes)
+    return QueryResult([ratingstablename], query, params, 1, fanout=False)
+
+
+@uses_connection
+def userquery(ratingstablename, userid, openconnection=None) -> QueryResult:
+    """
+    Mọi rating của @userid. Có phân mảnh hash thì chỉ đọc một phân mảnh; ngược lại quét song song mọi phân mảnh
+    range hoặc round robin (hoặc bảng gốc)
+    """
+    query = "SELECT userid, movieid, rating FROM {table} WHERE userid = %s"
+    params = (userid,)
+
+    partition, partitions_total = _hash_partition_table(userid, openconnection)
+    if partition:
+        return QueryResult(partition[0], query, params, partitions_total, nodes=partition[1])
+    for partition_type in ('range', 'rrobin'):
+        partitions = partition_tables(partition_type, openconnection)
+        if partitions:
+            tables, nodes = partitions
+            return QueryResult(tables, query, params, len(tables), nodes=nodes)
+    return QueryResult([ratingstablename], query, params, 1)
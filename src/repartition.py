@@ -0,0 +1,300 @@
+import psycopg2.extensions
+
+from . import metrics
+from .Interface import (PartitionMetadata, PartitionStats, finish_bulk_table, lock_partition_metadata,
+                        lock_range_partitions, lock_rrobin_slots, rating_bucket_expression, read_partition_stats,
+                        save_partition_metadata, save_partition_stats, scan_partition_stats, stats_by_slot, stats_query,
+                        uniform_range_boundaries, uses_connection)
+
+RANGE_TABLE_PREFIX = 'range_part'
+RROBIN_TABLE_PREFIX = 'rrobin_part'
+
+
+def move_rows(cursor: psycopg2.extensions.cursor, source, target, condition=None) -> PartitionStats:
+    """Chuyển các dòng của @source thoả @condition sang @target bằng một DELETE ... RETURNING; trả về thống kê"""
+    cursor.execute(f"""
+        WITH moved AS (
+            DELETE FROM {source}
+            WHERE {condition or "TRUE"}
+            RETURNING userid, movieid, rating
+        ), inserted AS (
+            INSERT INTO {target} (userid, movieid, rating)
+            SELECT userid, movieid, rating FROM moved
+        )
+        {stats_query('moved')};
+    """)
+    return PartitionStats.from_buckets(cursor.fetchall())
+
+
+def number_rrobin_partitions(cursor: psycopg2.extensions.cursor, current, numberofpartitions) -> str:
+    """
+    Đánh số lại các dòng của rrobin_part0 .. @current-1 như round-robin trên @numberofpartitions phân mảnh, vào bảng
+    tạm (source, row_ctid, slot). Dòng thứ p (theo ctid, tức thứ tự chèn) của phân mảnh i có số thứ tự cũ p * N + i;
+    dòng thứ k theo thứ tự đó có slot k % M. Trả về tên bảng tạm, bị xoá khi commit
+    """
+    tablename = "grow_rrobin_slots"
+    numbered = " UNION ALL ".join(
+        f"SELECT {i} AS source, ctid AS row_ctid, row_number() OVER (ORDER BY ctid) AS position "
+        f"FROM {RROBIN_TABLE_PREFIX}{i}" for i in range(current))
+    cursor.execute(f"""
+        DROP TABLE IF EXISTS {tablename};
+        CREATE TEMP TABLE {tablename} ON COMMIT DROP AS
+        SELECT source, row_ctid, mod(row_number() OVER (ORDER BY position, source) - 1, {numberofpartitions}) AS slot
+        FROM ({numbered}) AS numbered;
+    """)
+    return tablename
+
+
+def deal_rows(cursor: psycopg2.extensions.cursor, slots, source, numberofpartitions) -> list[PartitionStats]:
+    """
+    Chuyển các dòng của rrobin_part{@source} có slot khác @source trong bảng @slots (number_rrobin_partitions)
+    sang rrobin_part{slot}, bằng một câu lệnh. Trả về thống kê của các dòng chuyển vào từng phân mảnh
+    """
+    inserts = "".join(f"""
+        , inserted{i} AS (
+            INSERT INTO {RROBIN_TABLE_PREFIX}{i} (userid, movieid, rating)
+            SELECT userid, movieid, rating FROM moved WHERE slot = {i}
+        )""" for i in range(numberofpartitions) if i != source)
+    cursor.execute(f"""
+        WITH moved AS (
+            DELETE FROM {RROBIN_TABLE_PREFIX}{source} p
+            USING {slots} s
+            WHERE s.source = {source} AND s.slot <> {source} AND p.ctid = s.row_ctid
+            RETURNING p.userid, p.movieid, p.rating, s.slot
+        ){inserts}
+        SELECT slot, {rating_bucket_expression()}, count(*), min(rating), max(rating)
+        FROM moved
+        GROUP BY 1, 2;
+    """)
+    return stats_by_slot(cursor.fetchall(), numberofpartitions)[1]
+
+
+def current_partition_stats(cursor: psycopg2.extensions.cursor, metadata: PartitionMetadata, tableprefix,
+                            for_update=True) -> list[PartitionStats]:
+    """
+    Thống kê trong catalog của các phân mảnh @metadata, khoá đến khi commit nếu @for_update. Phân mảnh chưa có thống
+    kê (dựng trước khi có partition_stats) thì quét lại, nên phải gọi trước khi chuyển dòng hay đổi tên phân mảnh
+    """
+    return (read_partition_stats(cursor, metadata.partition_type, metadata.partition_count, for_update)
+            or [scan_partition_stats(cursor, f"{tableprefix}{i}") for i in range(metadata.partition_count)])
+
+
+def rename_partition(cursor: psycopg2.extensions.cursor, tablename, newname) -> None:
+    """Đổi tên bảng cùng khoá chính của nó, để tên index luôn khớp tên bảng và không đụng độ về sau"""
+    cursor.execute("""
+        SELECT conname FROM pg_constraint
+        WHERE conrelid = %s::regclass AND contype = 'p'
+    """, (tablename,))
+    row = cursor.fetchone()
+    cursor.execute(f"ALTER TABLE {tablename} RENAME TO {newname};")
+    if row and row[0] != f"{newname}_pkey":
+        cursor.execute(f"ALTER TABLE {newname} RENAME CONSTRAINT {row[0]} TO {newname}_pkey;")
+
+
+def shift_partitions(cursor: psycopg2.extensions.cursor, tableprefix, start, stop, step) -> None:
+    """Đổi tên {tableprefix}{start} .. {tableprefix}{stop - 1} thành chỉ số + @step, theo thứ tự tránh trùng tên"""
+    indexes = range(stop - 1, start - 1, -1) if step > 0 else range(start, stop)
+    for i in indexes:
+        rename_partition(cursor, f"{tableprefix}{i}", f"{tableprefix}{i + step}")
+
+
+def begin_range_change(cursor: psycopg2.extensions.cursor, *indexes) -> PartitionMetadata:
+    """
+    Bắt đầu chia/gộp phân mảnh range: khoá advisory riêng chờ các lệnh chèn range đang chạy commit và giữ các lệnh
+    mới đến khi xong (chúng thấy phiên bản mới rồi định tuyến lại), rồi chặn các thao tác ghi khác vào
+    range_part{@indexes}; lệnh đọc không bị chặn. Trả về metadata hiện tại
+    """
+    lock_range_partitions(cursor, exclusive=True)
+    metadata = lock_partition_metadata(cursor, 'range')
+    if not metadata or not metadata.partition_count:
+        raise ValueError("No range partitions found")
+    if metadata.nodes:
+        raise ValueError("Range partitions placed on several nodes cannot be split or merged")
+    for i in indexes:
+        if not 0 <= i < metadata.partition_count:
+            raise ValueError(f"No range partition {i}")
+        cursor.execute(f"LOCK TABLE {RANGE_TABLE_PREFIX}{i} IN SHARE ROW EXCLUSIVE MODE;")
+    return metadata
+
+
+@uses_connection
+@metrics.timed()
+def splitrangepartition(index, splitvalue=None, openconnection=None) -> float:
+    """
+    Chia range_part{@index} tại @splitvalue (mặc định: trung vị rating) thành (lower, splitvalue] và (splitvalue,
+    upper]: chỉ nửa trên được chuyển sang bảng mới làm range_part{@index + 1}, các phân mảnh sau đổi tên lên một chỉ
+    số. Chuyển dòng, đổi tên, metadata và thống kê nằm trong một transaction nên không ai thấy phân mảnh chuyển dở;
+    lệnh ghi vào các phân mảnh liên quan chờ đến khi commit. Trả về giá trị chia
+    """
+    timer = metrics.current_timer()
+    cur = openconnection.cursor()
+    try:
+        metadata = begin_range_change(cur, index)
+        # Đọc (hoặc quét) thống kê trước khi chuyển dòng và đổi tên phân mảnh
+        stats = current_partition_stats(cur, metadata, RANGE_TABLE_PREFIX, for_update=False)
+        boundaries = list(metadata.boundaries or uniform_range_boundaries(metadata.partition_count))
+        lower = boundaries[index - 1] if index else None
+        upper = boundaries[index]
+        source = f"{RANGE_TABLE_PREFIX}{index}"
+
+        if splitvalue is None:
+            cur.execute(f"SELECT percentile_disc(0.5) WITHIN GROUP (ORDER BY rating) FROM {source};")
+            splitvalue = cur.fetchone()[0]
+            if splitvalue is not None and splitvalue >= upper:
+                # Phần lớn các dòng có rating bằng cận trên: tách ngay dưới giá trị đó
+                cur.execute(f"SELECT max(rating) FROM {source} WHERE rating < %s;", (upper,))
+                splitvalue = cur.fetchone()[0]
+            if splitvalue is None:
+                raise ValueError(f"{source} holds a single rating value and cannot be split")
+        if splitvalue >= upper or (lower is not None and splitvalue <= lower):
+            raise ValueError(f"Split value {splitvalue} is outside the band of {source}")
+
+        target = f"split_{RANGE_TABLE_PREFIX}"
+        cur.execute(f"""
+            DROP TABLE IF EXISTS {target};
+            CREATE TABLE {target} (
+                userid INTEGER,
+                movieid INTEGER,
+                rating FLOAT
+            );
+        """)
+        moved = move_rows(cur, source, target, f"rating > {float(splitvalue)!r}")
+        finish_bulk_table(cur, target, False)
+
+        # Đổi tên sau cùng để khoá ACCESS EXCLUSIVE trên các phân mảnh chỉ bị giữ trong thời gian ngắn nhất.
+        # Một bảng range_part{N} có thể còn sót lại từ lần phân mảnh trước với nhiều phân mảnh hơn
+        cur.execute(f"DROP TABLE IF EXISTS {RANGE_TABLE_PREFIX}{len(boundaries)};")
+        shift_partitions(cur, RANGE_TABLE_PREFIX, index + 1, len(boundaries), 1)
+        rename_partition(cur, target, f"{RANGE_TABLE_PREFIX}{index + 1}")
+
+        boundaries.insert(index, float(splitvalue))
+        save_partition_metadata(cur, 'range', len(boundaries), boundaries=boundaries)
+
+        # Các lệnh chèn range đã commit trước khoá advisory riêng; đọc lại catalog để có cả các dòng vừa chèn vào
+        # những phân mảnh khác
+        stats = read_partition_stats(cur, 'range', metadata.partition_count, for_update=True) or stats
+        stats[index:index + 1] = [stats[index].remove(moved), moved]
+        save_partition_stats(cur, 'range', stats)
+
+        openconnection.commit()
+        timer.rows = moved.rows
+        timer.fields.update(table=source, splitvalue=splitvalue)
+        return splitvalue
+
+    except Exception:
+        openconnection.rollback()
+        raise
+    finally:
+        cur.close()
+
+
+@uses_connection
+@metrics.timed()
+def mergerangepartitions(index, openconnection=None) -> int:
+    """
+    Gộp hai phân mảnh range kề nhau range_part{@index} và range_part{@index + 1} vào range_part{@index}: chỉ chuyển
+    dòng của phân mảnh nhỏ hơn (theo thống kê), các phân mảnh sau đổi tên xuống một chỉ số. Mọi bước nằm trong một
+    transaction như splitrangepartition. Trả về số dòng đã chuyển
+    """
+    timer = metrics.current_timer()
+    cur = openconnection.cursor()
+    try:
+        metadata = begin_range_change(cur, index, index + 1)
+        boundaries = list(metadata.boundaries or uniform_range_boundaries(metadata.partition_count))
+        left, right = f"{RANGE_TABLE_PREFIX}{index}", f"{RANGE_TABLE_PREFIX}{index + 1}"
+
+        # Hai phân mảnh đã bị khoá ghi nên số dòng trong catalog không đổi cho đến khi gộp xong
+        stats = current_partition_stats(cur, metadata, RANGE_TABLE_PREFIX, for_update=False)
+        left_rows, right_rows = stats[index].rows, stats[index + 1].rows
+
+        if left_rows >= right_rows:
+            moved = move_rows(cur, right, left)
+            cur.execute(f"DROP TABLE {right};")
+        else:
+            moved = move_rows(cur, left, right)
+            cur.execute(f"DROP TABLE {left};")
+            rename_partition(cur, right, left)
+        shift_partitions(cur, RANGE_TABLE_PREFIX, index + 2, len(boundaries), -1)
+
+        del boundaries[index]
+        save_partition_metadata(cur, 'range', len(boundaries), boundaries=boundaries)
+
+        # Như khi tách: đọc lại catalog sau metadata, các thống kê quét trước khi gộp vẫn đúng nếu không có catalog
+        stats = read_partition_stats(cur, 'range', metadata.partition_count, for_update=True) or stats
+        stats[index:index + 2] = [stats[index].add(stats[index + 1])]
+        save_partition_stats(cur, 'range', stats)
+
+        openconnection.commit()
+        timer.rows = moved.rows
+        timer.fields.update(tables=f"{left},{right}")
+        return moved.rows
+
+    except Exception:
+        openconnection.rollback()
+        raise
+    finally:
+        cur.close()
+
+
+@uses_connection
+@metrics.timed()
+def growroundrobinpartitions(numberofpartitions, openconnection=None) -> int:
+    """
+    Tăng rrobin_part0 .. N-1 lên @numberofpartitions phân mảnh, mỗi dòng nằm ở phân mảnh (số thứ tự % M) như khi
+    roundrobinpartition dựng lại trên M phân mảnh (number_rrobin_partitions); chỉ các dòng đổi phân mảnh bị chuyển và
+    lệnh chèn sau đó tiếp tục vòng từ tổng số dòng. Tất cả nằm trong một transaction cùng metadata và thống kê; lệnh
+    chèn round robin chờ khoá advisory đến khi commit. Trả về số dòng đã chuyển
+    """
+    timer = metrics.current_timer()
+    cur = openconnection.cursor()
+    try:
+        # Khoá advisory riêng: các lệnh chèn round-robin chờ đến khi mở rộng xong
+        lock_rrobin_slots(cur, exclusive=True)
+        metadata = lock_partition_metadata(cur, 'rrobin', for_update=True)
+        if not metadata or not metadata.partition_count:
+            raise ValueError("No round-robin partitions found")
+        if metadata.nodes:
+            raise ValueError("Round-robin partitions placed on several nodes cannot be grown")
+        current = metadata.partition_count
+        if numberofpartitions <= current:
+            raise ValueError(f"Round-robin partitions can only grow (currently {current})")
+
+        for i in range(current, numberofpartitions):
+            cur.execute(f"""
+                DROP TABLE IF EXISTS {RROBIN_TABLE_PREFIX}{i};
+                CREATE TABLE {RROBIN_TABLE_PREFIX}{i} (
+                    userid INTEGER,
+                    movieid INTEGER,
+                    rating FLOAT,
+                    PRIMARY KEY (userid, movieid)
+                );
+            """)
+
+        # Thống kê lấy từ catalog; roundrobininsert chờ khoá advisory nên các phân mảnh không đổi
+        stats = current_partition_stats(cur, metadata, RROBIN_TABLE_PREFIX)
+        stats += [PartitionStats.of([])] * (numberofpartitions - current)
+        total = sum(partition.rows for partition in stats)
+
+        # Đánh số một lần cho mọi phân mảnh trước khi chuyển dòng: ctid của các dòng cũ không đổi trong transaction
+        slots = number_rrobin_partitions(cur, current, numberofpartitions)
+        moved = 0
+        for source in range(current):
+            dealt = deal_rows(cur, slots, source, numberofpartitions)
+            for target, rows in enumerate(dealt):
+                stats[source], stats[target] = stats[source].remove(rows), stats[target].add(rows)
+                moved += rows.rows
+
+        # Vòng tiếp tục từ dòng thứ total, như khi vừa dựng lại trên M phân mảnh
+        save_partition_metadata(cur, 'rrobin', numberofpartitions, total - 1)
+        save_partition_stats(cur, 'rrobin', stats)
+
+        openconnection.commit()
+        timer.rows = moved
+        timer.fields.update(partitions=f"{current}->{numberofpartitions}", total_rows=total)
+        return moved
+
+    except Exception:
+        openconnection.rollback()
+        raise
+    finally:
+        cur.close()
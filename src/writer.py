@@ -0,0 +1,141 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from . import metrics
+from .Interface import rangeinsert_many, roundrobininsert_many
+
+# Hàm chèn theo lô của từng cách phân mảnh; mỗi lần gọi định tuyến và ghi cả lô trong một transaction
+INSERTS = {
+    'range': rangeinsert_many,
+    'rrobin': roundrobininsert_many,
+}
+
+_FLUSH = object()
+_STOP = object()
+
+
+class RatingWriter:
+    """
+    Bộ ghi group-commit (tuỳ chọn): rating gửi từ nhiều luồng được xếp hàng và một luồng nền ghi theo lô, định tuyến
+    theo @partition_type (range hoặc round robin) và commit trong một transaction, để nhiều dòng dùng chung một lần
+    commit (một lần fsync). Lô được ghi khi đủ @max_batch dòng hoặc dòng đầu đã chờ @max_delay giây; với @max_delay
+    mặc định 0 thì ghi ngay khi hàng đợi rỗng, các dòng đến trong lúc đó thành lô sau, nên lô lớn dần theo tải.
+
+    submit() trả về Future nhận None khi dòng đã commit, hoặc lỗi. Tối đa @max_pending dòng chờ: submit() bị chặn
+    khi hàng đợi đầy. Lô lỗi được ghi lại từng dòng để chỉ dòng gây lỗi thất bại. close() (hoặc ra khỏi khối `with`)
+    ghi hết các dòng đã gửi rồi dừng luồng
+    """
+
+    def __init__(self, ratingstablename, partition_type='range', max_batch=1000, max_delay=0.0, max_pending=10000):
+        if partition_type not in INSERTS:
+            raise ValueError(f"RatingWriter supports {', '.join(INSERTS)} partitions, not '{partition_type}'")
+        self.ratingstablename = ratingstablename
+        self.partition_type = partition_type
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._insert = INSERTS[partition_type]
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._closed = False
+        self._close_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='rating-writer', daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def submit(self, userid, movieid, rating, timeout=None) -> Future:
+        """Xếp (@userid, @movieid, @rating) vào hàng đợi; chờ tối đa @timeout giây khi đầy (rồi ném queue.Full)"""
+        if self._closed:
+            raise RuntimeError("RatingWriter is closed")
+        future = Future()
+        self._queue.put(((userid, movieid, rating), future), timeout=timeout)
+        if self._closed and not self._thread.is_alive():
+            # close() đã xong trong lúc chờ chỗ trống trong hàng đợi: không còn ai ghi dòng này
+            self._fail_pending()
+        return future
+
+    def flush(self, timeout=None) -> None:
+        """Ghi ngay mọi dòng đã gửi và chờ đến khi chúng được commit (hoặc lỗi)"""
+        self._control(_FLUSH).result(timeout)
+
+    def close(self, timeout=None) -> None:
+        """Ghi các dòng còn trong hàng đợi rồi dừng luồng ghi; submit() sau đó ném RuntimeError"""
+        with self._close_lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._control(_STOP).result(timeout)
+        self._thread.join(timeout)
+        self._fail_pending()
+
+    def _control(self, marker) -> Future:
+        future = Future()
+        self._queue.put((marker, future))
+        return future
+
+    def _fail_pending(self) -> None:
+        while True:
+            try:
+                _, future = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if future.set_running_or_notify_cancel():
+                future.set_exception(RuntimeError("RatingWriter is closed"))
+
+    def _run(self) -> None:
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                row, future = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                # Hết dòng chờ, hoặc dòng đầu tiên của lô đã chờ đủ max_delay
+                self._write(batch)
+                batch, deadline = [], None
+                continue
+
+            if row is _FLUSH or row is _STOP:
+                self._write(batch)
+                batch, deadline = [], None
+                future.set_result(None)
+                if row is _STOP:
+                    return
+                continue
+
+            # Dòng bị huỷ trước khi được ghi thì bỏ qua
+            if not future.set_running_or_notify_cancel():
+                continue
+            batch.append((row, future))
+            if deadline is None:
+                deadline = time.monotonic() + self.max_delay
+            if len(batch) >= self.max_batch:
+                self._write(batch)
+                batch, deadline = [], None
+
+    def _write(self, batch) -> None:
+        if not batch:
+            return
+        with metrics.timer('rating_writer', partition_type=self.partition_type) as timer:
+            timer.rows = len(batch)
+            timer.fields['queued'] = self._queue.qsize()
+            try:
+                self._insert(self.ratingstablename, [row for row, _ in batch])
+            except Exception:
+                # Một dòng lỗi (ví dụ trùng khoá) làm hỏng cả lô: ghi lại từng dòng để chỉ dòng đó thất bại
+                timer.fields['retried'] = True
+                for row, future in batch:
+                    try:
+                        self._insert(self.ratingstablename, [row])
+                    except Exception as e:
+                        future.set_exception(e)
+                    else:
+                        future.set_result(None)
+                return
+        for _, future in batch:
+            future.set_result(None)
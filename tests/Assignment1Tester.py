@@ -7,12 +7,14 @@ DATABASE_NAME = 'postgres'
 RATINGS_TABLE = 'ratings'
 RANGE_TABLE_PREFIX = 'range_part'
 RROBIN_TABLE_PREFIX = 'rrobin_part'
+HASH_TABLE_PREFIX = 'hash_part'
 USER_ID_COLNAME = 'userid'
 MOVIE_ID_COLNAME = 'movieid'
 RATING_COLNAME = 'rating'
 INPUT_FILE_PATH = 'data/ml-10m/ml-10M100K/ratings.dat'
 ACTUAL_ROWS_IN_INPUT_FILE =  10000054  # Number of lines in the input file
 
+import logging
 import psycopg2.extensions
 import traceback
 import testHelper
@@ -20,8 +22,14 @@ import sys
 import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import src.Interface as MyAssignment
+import src.writer as MyWriter
+import src.repartition as MyRepartition
+import src.query as MyQuery
+import src.aggregate as MyAggregate
 
 if __name__ == '__main__':
+    # Thời gian từng pha của các hàm trong Interface được ghi qua logging
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
     try:
         testHelper.createdb(DATABASE_NAME)
 
@@ -50,6 +58,25 @@ if __name__ == '__main__':
             else:
                 print("rangeinsert function fail!")
 
+            [result, e] = testHelper.testpartitionstats(MyAssignment, 'range', 5, conn)
+            if result:
+                print("range partition statistics pass!")
+            else:
+                print("range partition statistics fail!")
+
+            [result, e] = testHelper.testratingwriter(MyAssignment, MyWriter, RATINGS_TABLE, 'range', 5, conn, 100000000)
+            if result:
+                print("RatingWriter (range) pass!")
+            else:
+                print("RatingWriter (range) fail!")
+
+            # Dọn dẹp của RatingWriter phải trả thống kê về đúng các phân mảnh
+            [result, e] = testHelper.testpartitionstats(MyAssignment, 'range', 5, conn)
+            if result:
+                print("range partition statistics after RatingWriter pass!")
+            else:
+                print("range partition statistics after RatingWriter fail!")
+
             testHelper.deleteAllPublicTables(conn)
             MyAssignment.loadratings(RATINGS_TABLE, INPUT_FILE_PATH, conn)
 
@@ -65,6 +92,83 @@ if __name__ == '__main__':
                 print("roundrobininsert function pass!")
             else:
                 print("roundrobininsert function fail!")
+
+            [result, e] = testHelper.testpartitionstats(MyAssignment, 'rrobin', 5, conn)
+            if result:
+                print("round robin partition statistics pass!")
+            else:
+                print("round robin partition statistics fail!")
+
+            [result, e] = testHelper.testratingwriter(MyAssignment, MyWriter, RATINGS_TABLE, 'rrobin', 5, conn, 100000000)
+            if result:
+                print("RatingWriter (round robin) pass!")
+            else:
+                print("RatingWriter (round robin) fail!")
+
+            # Dọn dẹp của RatingWriter phải trả thống kê về đúng các phân mảnh
+            [result, e] = testHelper.testpartitionstats(MyAssignment, 'rrobin', 5, conn)
+            if result:
+                print("round robin partition statistics after RatingWriter pass!")
+            else:
+                print("round robin partition statistics after RatingWriter fail!")
+
+            testHelper.deleteAllPublicTables(conn)
+            MyAssignment.loadratings(RATINGS_TABLE, INPUT_FILE_PATH, conn)
+
+            [result, e] = testHelper.testhashpartition(MyAssignment, RATINGS_TABLE, 5, conn, 0, ACTUAL_ROWS_IN_INPUT_FILE)
+            if result :
+                print("hashpartition function pass!")
+            else:
+                print("hashpartition function fail!")
+
+            # userid 100 thuộc phân mảnh 100 % 5 = 0
+            [result, e] = testHelper.testhashinsert(MyAssignment, RATINGS_TABLE, 100, 2, 3, conn, '0')
+            if result:
+                print("hashinsert function pass!")
+            else:
+                print("hashinsert function fail!")
+
+            [result, e] = testHelper.testpartitionstats(MyAssignment, 'hash', 5, conn)
+            if result:
+                print("hash partition statistics pass!")
+            else:
+                print("hash partition statistics fail!")
+
+            [result, e] = testHelper.testrefreshratings(MyAssignment, RATINGS_TABLE, INPUT_FILE_PATH, 5, conn)
+            if result:
+                print("refreshratings function pass!")
+            else:
+                print("refreshratings function fail!")
+
+            [result, e] = testHelper.testloadandpartition(MyAssignment, RATINGS_TABLE, INPUT_FILE_PATH, 5, conn)
+            if result:
+                print("loadandpartition function pass!")
+            else:
+                print("loadandpartition function fail!")
+
+            [result, e] = testHelper.testbuildoptions(MyAssignment, RATINGS_TABLE, INPUT_FILE_PATH, 5, conn)
+            if result:
+                print("workers/bulk/cache/adaptive options pass!")
+            else:
+                print("workers/bulk/cache/adaptive options fail!")
+
+            [result, e] = testHelper.testrepartition(MyAssignment, MyRepartition, RATINGS_TABLE, 5, conn)
+            if result:
+                print("split/merge/grow functions pass!")
+            else:
+                print("split/merge/grow functions fail!")
+
+            [result, e] = testHelper.testqueries(MyAssignment, MyQuery, RATINGS_TABLE, INPUT_FILE_PATH, 5, conn)
+            if result:
+                print("rangequery/pointquery/userquery functions pass!")
+            else:
+                print("rangequery/pointquery/userquery functions fail!")
+
+            [result, e] = testHelper.testaggregate(MyAssignment, MyAggregate, RATINGS_TABLE, INPUT_FILE_PATH, 5, conn)
+            if result:
+                print("aggregate function pass!")
+            else:
+                print("aggregate function fail!")
             # conn.close()
 
     except Exception as detail:
@@ -0,0 +1,85 @@
+#
+# Tester for the asyncio interface (src/async_interface.py): the scenarios of Assignment1Tester.py, plus
+# thousands of concurrent inserts checked for lost, duplicated or misplaced rows
+#
+DATABASE_NAME = 'postgres'
+
+RATINGS_TABLE = 'ratings'
+RANGE_TABLE_PREFIX = 'range_part'
+RROBIN_TABLE_PREFIX = 'rrobin_part'
+HASH_TABLE_PREFIX = 'hash_part'
+INPUT_FILE_PATH = 'data/ml-10m/ml-10M100K/ratings.dat'
+ACTUAL_ROWS_IN_INPUT_FILE =  10000054  # Number of lines in the input file
+CONCURRENT_INSERTS = 2000
+NEW_USERID = 1000000            # userid của các dòng chèn đồng thời, nằm ngoài tập dữ liệu
+
+import asyncio
+import logging
+import psycopg2.extensions
+import traceback
+import testHelper
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import src.async_interface as AsyncAssignment
+
+
+def report(name, result):
+    print("{0} function {1}!".format(name, "pass" if result[0] else "fail"))
+
+
+async def main(conn):
+    try:
+        testHelper.deleteAllPublicTables(conn)
+
+        report("async loadratings", await testHelper.testasyncloadratings(
+            AsyncAssignment, RATINGS_TABLE, INPUT_FILE_PATH, conn, ACTUAL_ROWS_IN_INPUT_FILE))
+
+        report("async rangepartition", await testHelper.testasyncrangepartition(
+            AsyncAssignment, RATINGS_TABLE, 5, conn, 0, ACTUAL_ROWS_IN_INPUT_FILE))
+        report("async rangeinsert", await testHelper.testasyncinsert(
+            AsyncAssignment, 'rangeinsert', RATINGS_TABLE, 100, 2, 3, conn, RANGE_TABLE_PREFIX + '2'))
+
+        testHelper.deleteAllPublicTables(conn)
+        await AsyncAssignment.loadratings(RATINGS_TABLE, INPUT_FILE_PATH)
+
+        report("async roundrobinpartition", await testHelper.testasyncroundrobinpartition(
+            AsyncAssignment, RATINGS_TABLE, 5, conn, 0, ACTUAL_ROWS_IN_INPUT_FILE, workers=5))
+        report("async roundrobininsert", await testHelper.testasyncinsert(
+            AsyncAssignment, 'roundrobininsert', RATINGS_TABLE, 100, 2, 3, conn,
+            RROBIN_TABLE_PREFIX + str(ACTUAL_ROWS_IN_INPUT_FILE % 5)))
+        report("concurrent async roundrobininsert", await testHelper.testasyncconcurrentinserts(
+            AsyncAssignment, 'roundrobininsert', RATINGS_TABLE, 5, CONCURRENT_INSERTS, NEW_USERID, conn,
+            RROBIN_TABLE_PREFIX, roundrobin=True))
+
+        testHelper.deleteAllPublicTables(conn)
+        await AsyncAssignment.loadratings(RATINGS_TABLE, INPUT_FILE_PATH)
+
+        report("async hashpartition", await testHelper.testasynchashpartition(
+            AsyncAssignment, RATINGS_TABLE, 5, conn, 0, ACTUAL_ROWS_IN_INPUT_FILE))
+        # userid 100 thuộc phân mảnh 100 % 5 = 0
+        report("async hashinsert", await testHelper.testasyncinsert(
+            AsyncAssignment, 'hashinsert', RATINGS_TABLE, 100, 2, 3, conn, HASH_TABLE_PREFIX + '0'))
+        report("concurrent async hashinsert", await testHelper.testasyncconcurrentinserts(
+            AsyncAssignment, 'hashinsert', RATINGS_TABLE, 5, CONCURRENT_INSERTS, NEW_USERID, conn,
+            HASH_TABLE_PREFIX, testHelper.hashconditions(5)))
+    finally:
+        await AsyncAssignment.close_connection_pool()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING, format='%(message)s')
+    try:
+        testHelper.createdb(DATABASE_NAME)
+
+        # Không dùng `with conn`: psycopg2 mở transaction kể cả ở chế độ autocommit, và các bảng bị xoá trong đó
+        # sẽ khoá các kết nối asyncpg
+        conn = testHelper.getopenconnection(dbname=DATABASE_NAME)
+        try:
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            asyncio.run(main(conn))
+        finally:
+            conn.close()
+
+    except Exception as detail:
+        traceback.print_exc()
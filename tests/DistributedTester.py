@@ -0,0 +1,81 @@
+#
+# Tester for partitions placed on several nodes. Every node is a database on the server configured in .env;
+# PostgreSQL must run with max_prepared_transactions > 0 for the two-phase commit of the inserts.
+#
+DATABASE_NAME = 'postgres'
+NODE_DATABASES = ['partition_node1', 'partition_node2']
+
+RATINGS_TABLE = 'ratings'
+INPUT_FILE_PATH = 'data/ml-10m/ml-10M100K/ratings.dat'
+ACTUAL_ROWS_IN_INPUT_FILE =  10000054  # Number of lines in the input file
+
+import logging
+import psycopg2.extensions
+import traceback
+import testHelper
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import src.Interface as MyAssignment
+
+
+def report(name, result):
+    print("{0} {1}!".format(name, "pass" if result[0] else "fail"))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    try:
+        testHelper.createdb(DATABASE_NAME)
+        nodes = []
+        for dbname in NODE_DATABASES:
+            testHelper.createdb(dbname)
+            nodes.append('dbname={0}'.format(dbname))
+
+        conn = testHelper.getopenconnection(dbname=DATABASE_NAME)
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        testHelper.deleteAllPublicTables(conn)
+        for node in nodes:
+            nodeconn = testHelper.getnodeconnection(node)
+            nodeconn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            testHelper.deleteAllPublicTables(nodeconn)
+            nodeconn.close()
+
+        report("loadratings function", testHelper.testloadratings(
+            MyAssignment, RATINGS_TABLE, INPUT_FILE_PATH, conn, ACTUAL_ROWS_IN_INPUT_FILE))
+
+        # Phân mảnh i nằm trên nút i % 2: range_part1 (rating 1.0 < r <= 2.0) nằm trên nút thứ hai
+        report("distributed rangepartition function", testHelper.testdistributedpartition(
+            MyAssignment, 'rangepartition', RATINGS_TABLE, 5, conn, nodes, ACTUAL_ROWS_IN_INPUT_FILE))
+        report("distributed rangeinsert function", testHelper.testdistributedinsert(
+            MyAssignment, 'rangeinsert', RATINGS_TABLE, 100, 2, 1.5, nodes[1], 'range_part1'))
+
+        testHelper.deleteAllPublicTables(conn)
+        MyAssignment.loadratings(RATINGS_TABLE, INPUT_FILE_PATH, conn)
+
+        report("distributed roundrobinpartition function", testHelper.testdistributedpartition(
+            MyAssignment, 'roundrobinpartition', RATINGS_TABLE, 5, conn, nodes, ACTUAL_ROWS_IN_INPUT_FILE))
+        # Dòng tiếp theo đi vào phân mảnh ACTUAL_ROWS_IN_INPUT_FILE % 5
+        index = ACTUAL_ROWS_IN_INPUT_FILE % 5
+        report("distributed roundrobininsert function", testHelper.testdistributedinsert(
+            MyAssignment, 'roundrobininsert', RATINGS_TABLE, 100, 3, 5, nodes[index % 2],
+            'rrobin_part{0}'.format(index)))
+
+        testHelper.deleteAllPublicTables(conn)
+        MyAssignment.loadratings(RATINGS_TABLE, INPUT_FILE_PATH, conn)
+
+        report("distributed hashpartition function", testHelper.testdistributedpartition(
+            MyAssignment, 'hashpartition', RATINGS_TABLE, 5, conn, nodes, ACTUAL_ROWS_IN_INPUT_FILE))
+        # userid 101 thuộc phân mảnh 101 % 5 = 1, trên nút thứ hai
+        report("distributed hashinsert function", testHelper.testdistributedinsert(
+            MyAssignment, 'hashinsert', RATINGS_TABLE, 101, 4, 3, nodes[1], 'hash_part1'))
+        report("distributed hashinsert atomicity", testHelper.testdistributedatomicity(
+            MyAssignment, RATINGS_TABLE, 101, 4, 3, nodes[1], conn))
+        report("recover_distributed_transactions function", testHelper.testdistributedrecovery(
+            MyAssignment, 'hash_part1', nodes[1], conn))
+
+        conn.close()
+        MyAssignment.close_connection_pool()
+
+    except Exception as detail:
+        traceback.print_exc()
@@ -1,3 +1,4 @@
+import asyncio
 import os
 import traceback
 import psycopg2
@@ -7,6 +8,7 @@ from dotenv import load_dotenv
 
 RANGE_TABLE_PREFIX = 'range_part'
 RROBIN_TABLE_PREFIX = 'rrobin_part'
+HASH_TABLE_PREFIX = 'hash_part'
 USER_ID_COLNAME = 'userid'
 MOVIE_ID_COLNAME = 'movieid'
 RATING_COLNAME = 'rating'
@@ -145,6 +147,108 @@ def totalrowsinallpartitions(cur, n, rangepartitiontableprefix, partitionstartin
     return count
 
 
+# Checksum of a row, summed over a table so the result does not depend on scan order. Hashing the numbers
+# directly is about 3x cheaper than hashing their text form.
+ROW_CHECKSUM = "(hashint8(({0}::bigint << 32) | {1}) # hashfloat8({2}))::bigint".format(
+    USER_ID_COLNAME, MOVIE_ID_COLNAME, RATING_COLNAME)
+
+
+def rangebandconditions(numberofpartitions):
+    """
+    Condition each range partition's rows must satisfy, with the same bands as getCountrangepartition
+    """
+    interval = 5.0 / numberofpartitions
+    conditions = ["{0} >= {1} and {0} <= {2}".format(RATING_COLNAME, 0, interval)]
+    lowerbound = interval
+    for i in range(1, numberofpartitions):
+        conditions.append("{0} > {1} and {0} <= {2}".format(RATING_COLNAME, lowerbound, lowerbound + interval))
+        lowerbound += interval
+    return conditions
+
+
+def hashconditions(numberofpartitions):
+    return ["mod(mod({0}, {1}) + {1}, {1}) = {2}".format(USER_ID_COLNAME, numberofpartitions, i)
+            for i in range(numberofpartitions)]
+
+
+def scantable(cur, tablename, condition=None):
+    """
+    One scan of @tablename: (row count, checksum, rows NOT matching @condition)
+    """
+    misplaced = "COUNT(*) FILTER (WHERE NOT ({0}))".format(condition) if condition else "0"
+    cur.execute("SELECT COUNT(*), COALESCE(SUM({0}), 0), {1} FROM {2}".format(ROW_CHECKSUM, misplaced, tablename))
+    count, checksum, misplaced = cur.fetchone()
+    return int(count), int(checksum), int(misplaced)
+
+
+def verifypartitions(ratingstablename, n, openconnection, partitiontableprefix, partitionstartindex=0, conditions=None):
+    """
+    Verify a partitioning with one scan of the base table and one scan of each partition.
+    Every scan returns the row count and an order-independent checksum of (userid, movieid, rating); with
+    @conditions (one per partition) it also counts the rows that do not belong to their partition.
+    :return: dict with the counts and the completeness, disjointness, reconstruction and placement verdicts
+    """
+    with openconnection.cursor() as cur:
+        rows, checksum, _ = scantable(cur, ratingstablename)
+        partitions = []
+        for i in range(n):
+            partitions.append(scantable(cur, '{0}{1}'.format(partitiontableprefix, i + partitionstartindex),
+                                        conditions[i] if conditions else None))
+
+    return partitionreport(rows, checksum, partitions)
+
+
+def partitionreport(rows, checksum, partitions):
+    """
+    Report of verifypartitions from the base table's (@rows, @checksum) and the scantable result of each partition
+    """
+    total = sum(count for count, _, _ in partitions)
+    return {
+        'rows': rows,
+        'partitionrows': [count for count, _, _ in partitions],
+        'misplaced': [misplaced for _, _, misplaced in partitions],
+        'total': total,
+        'checksum': checksum,
+        'partitionchecksum': sum(c for _, c, _ in partitions),
+        'completeness': total >= rows,
+        'disjointness': total <= rows,
+        # Cùng số dòng nhưng khác checksum: một số dòng bị mất và một số dòng khác bị thừa hoặc bị sửa
+        'reconstruction': total == rows and sum(c for _, c, _ in partitions) == checksum,
+        'placement': not any(misplaced for _, _, misplaced in partitions),
+    }
+
+
+def checkverification(report, expectedrows, partitiontableprefix, partitionstartindex=0, expectedcounts=None):
+    """
+    Raise the tester's exceptions for the first property that @report (from verifypartitions) violates
+    """
+    if report['rows'] != expectedrows: raise Exception(
+        "Expected {0} rows in the ratings table, but found {1} rows".format(expectedrows, report['rows']))
+    if not report['completeness']: raise Exception(
+        "Completeness property of Partitioning failed. Excpected {0} rows after merging all tables, but found {1} rows".format(
+            expectedrows, report['total']))
+    if not report['disjointness']: raise Exception(
+        "Dijointness property of Partitioning failed. Excpected {0} rows after merging all tables, but found {1} rows".format(
+            expectedrows, report['total']))
+    if not report['reconstruction']: raise Exception(
+        "Rescontruction property of Partitioning failed. Merging all tables gives {0} rows like the ratings table, "
+        "but different ones (checksum {1} instead of {2})".format(
+            report['total'], report['partitionchecksum'], report['checksum']))
+    for i, misplaced in enumerate(report['misplaced']):
+        if misplaced: raise Exception("{0}{1} holds {2} rows that belong to another partition".format(
+            partitiontableprefix, i + partitionstartindex, misplaced))
+    if expectedcounts:
+        for i, (count, expected) in enumerate(zip(report['partitionrows'], expectedcounts)):
+            if count != expected:
+                raise Exception("{0}{1} has {2} of rows while the correct number should be {3}".format(
+                    partitiontableprefix, i + partitionstartindex, count, expected))
+
+
+def roundrobincounts(rows, numberofpartitions):
+    """Số dòng mỗi phân mảnh round robin phải có: suy ra từ tổng số dòng, không cần quét lại bảng"""
+    return [rows // numberofpartitions + (1 if i < rows % numberofpartitions else 0) for i in range(numberofpartitions)]
+
+
 def testrangeandrobinpartitioning(n, openconnection, rangepartitiontableprefix, partitionstartindex, ACTUAL_ROWS_IN_INPUT_FILE):
     with openconnection.cursor() as cur:
         if not isinstance(n, int) or n < 0:
@@ -154,23 +258,32 @@ def testrangeandrobinpartitioning(n, openconnection, rangepartitiontableprefix,
             # Test 2: Check the number of tables created, if all args are correct
             checkpartitioncount(cur, n, rangepartitiontableprefix)
 
-            # Test 3: Test Completeness by SQL UNION ALL Magic
+            # Test 3-5: Completeness, Disjointness and Reconstruction from a single UNION ALL count
             count = totalrowsinallpartitions(cur, n, rangepartitiontableprefix, partitionstartindex)
             if count < ACTUAL_ROWS_IN_INPUT_FILE: raise Exception(
                 "Completeness property of Partitioning failed. Excpected {0} rows after merging all tables, but found {1} rows".format(
                     ACTUAL_ROWS_IN_INPUT_FILE, count))
-
-            # Test 4: Test Disjointness by SQL UNION Magic
-            count = totalrowsinallpartitions(cur, n, rangepartitiontableprefix, partitionstartindex)
             if count > ACTUAL_ROWS_IN_INPUT_FILE: raise Exception(
                 "Dijointness property of Partitioning failed. Excpected {0} rows after merging all tables, but found {1} rows".format(
                     ACTUAL_ROWS_IN_INPUT_FILE, count))
 
-            # Test 5: Test Reconstruction by SQL UNION Magic
-            count = totalrowsinallpartitions(cur, n, rangepartitiontableprefix, partitionstartindex)
-            if count != ACTUAL_ROWS_IN_INPUT_FILE: raise Exception(
-                "Rescontruction property of Partitioning failed. Excpected {0} rows after merging all tables, but found {1} rows".format(
-                    ACTUAL_ROWS_IN_INPUT_FILE, count))
+
+def testpartitioning(ratingstablename, n, openconnection, partitiontableprefix, partitionstartindex,
+                     ACTUAL_ROWS_IN_INPUT_FILE, conditions=None, roundrobin=False):
+    """
+    Test Completeness, Disjointness, Reconstruction and placement of every row with verifypartitions
+    :return: the verification report
+    """
+    with openconnection.cursor() as cur:
+        if not isinstance(n, int) or n < 0:
+            checkpartitioncount(cur, 0, partitiontableprefix)
+            return None
+        checkpartitioncount(cur, n, partitiontableprefix)
+
+    report = verifypartitions(ratingstablename, n, openconnection, partitiontableprefix, partitionstartindex, conditions)
+    checkverification(report, ACTUAL_ROWS_IN_INPUT_FILE, partitiontableprefix, partitionstartindex,
+                      roundrobincounts(report['rows'], n) if roundrobin else None)
+    return report
 
 
 def testrangerobininsert(expectedtablename, itemid, openconnection, rating, userid):
@@ -186,26 +299,17 @@ def testrangerobininsert(expectedtablename, itemid, openconnection, rating, user
         return True
 
 def testEachRangePartition(ratingstablename, n, openconnection, rangepartitiontableprefix):
-    countList = getCountrangepartition(ratingstablename, n, openconnection)
-    cur = openconnection.cursor()
-    for i in range(0, n):
-        cur.execute("select count(*) from {0}{1}".format(rangepartitiontableprefix, i))
-        count = int(cur.fetchone()[0])
-        if count != countList[i]:
-            raise Exception("{0}{1} has {2} of rows while the correct number should be {3}".format(
-                rangepartitiontableprefix, i, count, countList[i]
-            ))
+    report = verifypartitions(ratingstablename, n, openconnection, rangepartitiontableprefix, 0, rangebandconditions(n))
+    checkverification(report, report['rows'], rangepartitiontableprefix)
 
 def testEachRoundrobinPartition(ratingstablename, n, openconnection, roundrobinpartitiontableprefix):
-    countList = getCountroundrobinpartition(ratingstablename, n, openconnection)
-    cur = openconnection.cursor()
-    for i in range(0, n):
-        cur.execute("select count(*) from {0}{1}".format(roundrobinpartitiontableprefix, i))
-        count = cur.fetchone()[0]
-        if count != countList[i]:
-            raise Exception("{0}{1} has {2} of rows while the correct number should be {3}".format(
-                roundrobinpartitiontableprefix, i, count, countList[i]
-            ))
+    report = verifypartitions(ratingstablename, n, openconnection, roundrobinpartitiontableprefix)
+    checkverification(report, report['rows'], roundrobinpartitiontableprefix, 0, roundrobincounts(report['rows'], n))
+
+def testEachHashPartition(ratingstablename, n, openconnection, hashpartitiontableprefix):
+    # Mọi dòng của phân mảnh i thoả mod(userid, n) = i, nên mỗi người dùng chỉ nằm trong đúng một phân mảnh
+    report = verifypartitions(ratingstablename, n, openconnection, hashpartitiontableprefix, 0, hashconditions(n))
+    checkverification(report, report['rows'], hashpartitiontableprefix)
 
 # ##########
 
@@ -245,8 +349,8 @@ def testrangepartition(MyAssignment, ratingstablename, n, openconnection, partit
 
     try:
         MyAssignment.rangepartition(ratingstablename, n, openconnection)
-        testrangeandrobinpartitioning(n, openconnection, RANGE_TABLE_PREFIX, partitionstartindex, ACTUAL_ROWS_IN_INPUT_FILE)
-        testEachRangePartition(ratingstablename, n, openconnection, RANGE_TABLE_PREFIX)
+        testpartitioning(ratingstablename, n, openconnection, RANGE_TABLE_PREFIX, partitionstartindex,
+                         ACTUAL_ROWS_IN_INPUT_FILE, rangebandconditions(n) if isinstance(n, int) and n > 0 else None)
         return [True, None]
     except Exception as e:
         traceback.print_exc()
@@ -265,8 +369,50 @@ def testroundrobinpartition(MyAssignment, ratingstablename, numberofpartitions,
     """
     try:
         MyAssignment.roundrobinpartition(ratingstablename, numberofpartitions, openconnection)
-        testrangeandrobinpartitioning(numberofpartitions, openconnection, RROBIN_TABLE_PREFIX, partitionstartindex, ACTUAL_ROWS_IN_INPUT_FILE)
-        testEachRoundrobinPartition(ratingstablename, numberofpartitions, openconnection, RROBIN_TABLE_PREFIX)
+        testpartitioning(ratingstablename, numberofpartitions, openconnection, RROBIN_TABLE_PREFIX, partitionstartindex,
+                         ACTUAL_ROWS_IN_INPUT_FILE, roundrobin=True)
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    return [True, None]
+
+def testhashpartition(MyAssignment, ratingstablename, numberofpartitions, openconnection,
+                      partitionstartindex, ACTUAL_ROWS_IN_INPUT_FILE):
+    """
+    Tests the hash partitioning on userid for Completness, Disjointness and Reconstruction
+    :param ratingstablename: Argument for function to be tested
+    :param numberofpartitions: Argument for function to be tested
+    :param openconnection: Argument for function to be tested
+    :param partitionstartindex: Indicates how the table names are indexed. Do they start as hashpart1, 2 ... or hashpart0, 1, 2...
+    :return:Raises exception if any test fails
+    """
+    try:
+        MyAssignment.hashpartition(ratingstablename, numberofpartitions, openconnection)
+        testpartitioning(ratingstablename, numberofpartitions, openconnection, HASH_TABLE_PREFIX, partitionstartindex,
+                         ACTUAL_ROWS_IN_INPUT_FILE, hashconditions(numberofpartitions) if isinstance(numberofpartitions, int) and numberofpartitions > 0 else None)
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    return [True, None]
+
+def testhashinsert(MyAssignment, ratingstablename, userid, itemid, rating, openconnection, expectedtableindex):
+    """
+    Tests the hash insert function by checking whether the tuple is inserted in he Expected table you provide
+    :param ratingstablename: Argument for function to be tested
+    :param userid: Argument for function to be tested
+    :param itemid: Argument for function to be tested
+    :param rating: Argument for function to be tested
+    :param openconnection: Argument for function to be tested
+    :param expectedtableindex: The expected table to which the record has to be saved
+    :return:Raises exception if any test fails
+    """
+    try:
+        expectedtablename = HASH_TABLE_PREFIX + expectedtableindex
+        MyAssignment.hashinsert(ratingstablename, userid, itemid, rating, openconnection)
+        if not testrangerobininsert(expectedtablename, itemid, openconnection, rating, userid):
+            raise Exception(
+                'Hash insert failed! Couldnt find ({0}, {1}, {2}) tuple in {3} table'.format(userid, itemid, rating,
+                                                                                             expectedtablename))
     except Exception as e:
         traceback.print_exc()
         return [False, e]
@@ -317,4 +463,867 @@ def testrangeinsert(MyAssignment, ratingstablename, userid, itemid, rating, open
     except Exception as e:
         traceback.print_exc()
         return [False, e]
-    return [True, None]
\ No newline at end of file
+    return [True, None]
+
+
+def checkpartitionstats(MyAssignment, partitiontype, n, openconnection):
+    """
+    Raise if the statistics catalog of the @n @partitiontype partitions disagrees with a scan of them: every
+    partition must have its row count and rating histogram (11 buckets, bucket k holding ratings in (k/2 - 0.5, k/2])
+    and bounds of its ratings, and partition_skew must add them up
+    """
+    prefix = {'range': RANGE_TABLE_PREFIX, 'rrobin': RROBIN_TABLE_PREFIX, 'hash': HASH_TABLE_PREFIX}[partitiontype]
+    stats = MyAssignment.get_partition_stats(partitiontype, openconnection)
+    if stats is None or len(stats) != n:
+        raise Exception("Expected statistics of {0} {1} partitions, but found {2}".format(
+            n, partitiontype, None if stats is None else len(stats)))
+    with openconnection.cursor() as cur:
+        for i, partition in enumerate(stats):
+            tablename = '{0}{1}'.format(prefix, i)
+            cur.execute("SELECT COUNT(*), MIN({0}), MAX({0}) FROM {1}".format(RATING_COLNAME, tablename))
+            count, minrating, maxrating = cur.fetchone()
+            cur.execute("SELECT LEAST(GREATEST(CEIL({0} * 2)::int, 0), 10), COUNT(*) FROM {1} GROUP BY 1".format(
+                RATING_COLNAME, tablename))
+            histogram = [0] * 11
+            for bucket, bucketcount in cur.fetchall():
+                histogram[bucket] = bucketcount
+            if partition.rows != count or list(partition.histogram) != histogram:
+                raise Exception("Statistics of {0} say {1} rows {2}, but it holds {3} rows {4}".format(
+                    tablename, partition.rows, list(partition.histogram), count, histogram))
+            if count and not (partition.min_rating <= minrating and partition.max_rating >= maxrating):
+                raise Exception("Statistics of {0} bound its ratings by [{1}, {2}], but they span [{3}, {4}]".format(
+                    tablename, partition.min_rating, partition.max_rating, minrating, maxrating))
+            if partition.size_bytes is None or partition.size_bytes <= 0:
+                raise Exception("Statistics of {0} have no size on disk".format(tablename))
+    openconnection.commit()
+    skew = MyAssignment.partition_skew(partitiontype, openconnection)
+    if skew['rows'] != sum(partition.rows for partition in stats) or skew['imbalance'] < 1.0:
+        raise Exception("partition_skew does not match the statistics: {0}".format(skew))
+
+
+def testpartitionstats(MyAssignment, partitiontype, n, openconnection):
+    """
+    Tests MyAssignment.get_partition_stats and partition_skew after the @n @partitiontype partitions were built
+    and written to, against a scan of every partition
+    """
+    try:
+        checkpartitionstats(MyAssignment, partitiontype, n, openconnection)
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    return [True, None]
+
+
+def writechangedratings(inputpath, outputpath, every=1000, newratings=1000):
+    """
+    Write a copy of the ratings file @inputpath to @outputpath that leaves out one rating in @every, re-rates
+    another one in @every and appends @newratings ratings of new users
+    :return: (rows, inserted, updated, deleted) of the new file
+    """
+    rows = inserted = updated = deleted = 0
+    maxuserid = 0
+    with open(inputpath) as src, open(outputpath, 'w') as dst:
+        for i, line in enumerate(src):
+            parts = line.strip().split('::')
+            if len(parts) < 3:
+                continue
+            maxuserid = max(maxuserid, int(parts[0]))
+            if i % every == 0:
+                deleted += 1
+                continue
+            if i % every == 1:
+                parts[2] = '{0:g}'.format(5.5 - float(parts[2]))
+                updated += 1
+            dst.write('::'.join(parts) + '\n')
+            rows += 1
+        for i in range(newratings):
+            dst.write('{0}::{1}::{2:g}::0\n'.format(maxuserid + 1 + i // 100, i % 100 + 1, (i % 10 + 1) / 2))
+            rows += 1
+            inserted += 1
+    return rows, inserted, updated, deleted
+
+
+def testrefreshratings(MyAssignment, ratingstablename, filepath, n, openconnection):
+    """
+    Tests MyAssignment.refreshratings: without the table it must load @filepath in full. After partitioning it
+    @n ways by range, round robin and hash and range-inserting one of the copy's new keys with another rating, a
+    changed copy of the file is applied. The table must then equal a fresh load of the copy and every
+    partitioning must pass the verification of testpartitioning and of checkpartitionstats again.
+    """
+    import tempfile
+    changedpath = os.path.join(tempfile.gettempdir(), 'ratings-refresh-test.dat')
+    expectedtablename = ratingstablename + '_expected'
+    try:
+        deleteAllPublicTables(openconnection)
+        result = MyAssignment.refreshratings(ratingstablename, filepath, openconnection)
+        with openconnection.cursor() as cur:
+            cur.execute('SELECT COUNT(*) from {0}'.format(ratingstablename))
+            loaded = int(cur.fetchone()[0])
+        if result != {'inserted': loaded, 'updated': 0, 'deleted': 0}:
+            raise Exception("refreshratings without {0} reported {1}, expected a full load of {2} rows".format(
+                ratingstablename, result, loaded))
+
+        MyAssignment.rangepartition(ratingstablename, n, openconnection)
+        MyAssignment.roundrobinpartition(ratingstablename, n, openconnection)
+        MyAssignment.hashpartition(ratingstablename, n, openconnection)
+
+        rows, inserted, updated, deleted = writechangedratings(filepath, changedpath)
+        # rangeinsert writes only the partition: the changed file's rating of the same key must replace that row
+        with openconnection.cursor() as cur:
+            cur.execute('SELECT MAX(userid) from {0}'.format(ratingstablename))
+            newuserid = int(cur.fetchone()[0]) + 1
+        openconnection.commit()
+        MyAssignment.rangeinsert(ratingstablename, newuserid, 1, 5.0, openconnection)
+        result = MyAssignment.refreshratings(ratingstablename, changedpath, openconnection)
+        expected = {'inserted': inserted, 'updated': updated, 'deleted': deleted}
+        if result != expected:
+            raise Exception("refreshratings reported {0}, expected {1}".format(result, expected))
+
+        MyAssignment.loadratings(expectedtablename, changedpath, openconnection)
+        with openconnection.cursor() as cur:
+            actual = scantable(cur, ratingstablename)[:2]
+            if actual != scantable(cur, expectedtablename)[:2]:
+                raise Exception("{0} differs from a fresh load of the changed file".format(ratingstablename))
+
+        testpartitioning(ratingstablename, n, openconnection, RANGE_TABLE_PREFIX, 0, rows, rangebandconditions(n))
+        testpartitioning(ratingstablename, n, openconnection, RROBIN_TABLE_PREFIX, 0, rows)
+        testpartitioning(ratingstablename, n, openconnection, HASH_TABLE_PREFIX, 0, rows, hashconditions(n))
+        for partitiontype in ('range', 'rrobin', 'hash'):
+            checkpartitionstats(MyAssignment, partitiontype, n, openconnection)
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    finally:
+        openconnection.rollback()
+        with openconnection.cursor() as cur:
+            cur.execute("DROP TABLE IF EXISTS {0}".format(expectedtablename))
+        openconnection.commit()
+        if os.path.exists(changedpath):
+            os.remove(changedpath)
+    return [True, None]
+
+
+def testloadandpartition(MyAssignment, ratingstablename, filepath, n, openconnection):
+    """
+    Tests MyAssignment.loadandpartition on a copy of @filepath with a rating below 0 and one above 5 appended: the
+    table and its @n range and round-robin partitions must pass testpartitioning and checkpartitionstats, and
+    every partition must hold the same rows as when rangepartition (with one and with several workers) and
+    roundrobinpartition build it from that table. Out-of-band ratings must land in the same partition on every path.
+    """
+    import shutil
+    import tempfile
+    outofbandpath = os.path.join(tempfile.gettempdir(), 'ratings-loadandpartition-test.dat')
+    try:
+        shutil.copyfile(filepath, outofbandpath)
+        with open(outofbandpath, 'a') as f:
+            f.write('0::1::-0.5::0\n0::2::5.5::0\n')
+
+        deleteAllPublicTables(openconnection)
+        rows = MyAssignment.loadandpartition(ratingstablename, outofbandpath, n, n, openconnection)
+        testpartitioning(ratingstablename, n, openconnection, RANGE_TABLE_PREFIX, 0, rows)
+        testpartitioning(ratingstablename, n, openconnection, RROBIN_TABLE_PREFIX, 0, rows, roundrobin=True)
+        for partitiontype in ('range', 'rrobin'):
+            checkpartitionstats(MyAssignment, partitiontype, n, openconnection)
+
+        def scanpartitions(prefix):
+            with openconnection.cursor() as cur:
+                return [scantable(cur, '{0}{1}'.format(prefix, i))[:2] for i in range(n)]
+
+        loaded = {prefix: scanpartitions(prefix) for prefix in (RANGE_TABLE_PREFIX, RROBIN_TABLE_PREFIX)}
+        for build, prefix, workers in ((MyAssignment.rangepartition, RANGE_TABLE_PREFIX, 1),
+                                       (MyAssignment.rangepartition, RANGE_TABLE_PREFIX, 2),
+                                       (MyAssignment.roundrobinpartition, RROBIN_TABLE_PREFIX, 1)):
+            build(ratingstablename, n, openconnection, workers=workers)
+            built = scanpartitions(prefix)
+            if built != loaded[prefix]:
+                raise Exception("{0} with {1} workers built (rows, checksum) {2}, loadandpartition {3}".format(
+                    build.__name__, workers, built, loaded[prefix]))
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    finally:
+        if os.path.exists(outofbandpath):
+            os.remove(outofbandpath)
+    return [True, None]
+
+
+def checklogged(tables, openconnection):
+    """
+    Raise if one of @tables is still UNLOGGED (a bulk build must switch it back) or has no primary key
+    """
+    with openconnection.cursor() as cur:
+        cur.execute("SELECT relname, relpersistence, EXISTS (SELECT 1 FROM pg_constraint WHERE conrelid = c.oid "
+                    "AND contype = 'p') FROM pg_class c WHERE relname = ANY(%s) AND relkind = 'r'", (list(tables),))
+        found = {name: (persistence, haskey) for name, persistence, haskey in cur.fetchall()}
+    openconnection.commit()
+    for table in tables:
+        if found.get(table, ('p', True))[0] != 'p':
+            raise Exception("{0} is still UNLOGGED after a bulk build".format(table))
+        if not found.get(table, ('p', True))[1]:
+            raise Exception("{0} has no primary key after the build".format(table))
+
+
+def testbuildoptions(MyAssignment, ratingstablename, filepath, n, openconnection):
+    """
+    Tests the options of the load and partition functions against their default path, by row checksums:
+    loadratings with several workers, bulk=True and cache=True (a cache miss, then a hit, alone and with workers)
+    must load the same rows as the default load; range, round robin and hash partitions built with several workers
+    or bulk=True must hold the same rows as the default build, LOGGED and with their primary key. adaptive=True must
+    place every row inside the boundaries it records, no partition larger than the largest uniform one, and keep
+    checkpartitionstats passing. The table is left loaded from @filepath.
+    """
+    import shutil
+    import tempfile
+
+    def scanpartitions(prefix):
+        with openconnection.cursor() as cur:
+            return [scantable(cur, '{0}{1}'.format(prefix, i))[:2] for i in range(n)]
+
+    cachedir = tempfile.mkdtemp(prefix='ratings-cache-test-')
+    previouscachedir = os.environ.get('RATINGS_CACHE_DIR')
+    os.environ['RATINGS_CACHE_DIR'] = cachedir
+    try:
+        deleteAllPublicTables(openconnection)
+        MyAssignment.loadratings(ratingstablename, filepath, openconnection)
+        with openconnection.cursor() as cur:
+            loaded = scantable(cur, ratingstablename)[:2]
+
+        for options in ({'workers': 2}, {'bulk': True}, {'cache': True}, {'cache': True},
+                        {'cache': True, 'workers': 2, 'bulk': True}):
+            MyAssignment.loadratings(ratingstablename, filepath, openconnection, **options)
+            with openconnection.cursor() as cur:
+                reloaded = scantable(cur, ratingstablename)[:2]
+            if reloaded != loaded:
+                raise Exception("loadratings with {0} loaded (rows, checksum) {1}, the default load {2}".format(
+                    options, reloaded, loaded))
+            checklogged([ratingstablename], openconnection)
+        if not os.listdir(cachedir):
+            raise Exception("loadratings with cache=True left no cache file in {0}".format(cachedir))
+
+        for build, prefix, partitiontype in ((MyAssignment.rangepartition, RANGE_TABLE_PREFIX, 'range'),
+                                             (MyAssignment.roundrobinpartition, RROBIN_TABLE_PREFIX, 'rrobin'),
+                                             (MyAssignment.hashpartition, HASH_TABLE_PREFIX, 'hash')):
+            build(ratingstablename, n, openconnection)
+            expected = scanpartitions(prefix)
+            for options in ({'workers': 2}, {'bulk': True}, {'workers': 2, 'bulk': True}):
+                build(ratingstablename, n, openconnection, **options)
+                built = scanpartitions(prefix)
+                if built != expected:
+                    raise Exception("{0} with {1} built (rows, checksum) {2}, the default build {3}".format(
+                        build.__name__, options, built, expected))
+                checklogged(['{0}{1}'.format(prefix, i) for i in range(n)], openconnection)
+                checkpartitionstats(MyAssignment, partitiontype, n, openconnection)
+
+        uniform = max(count for count, _ in scanpartitions(RANGE_TABLE_PREFIX))
+        MyAssignment.rangepartition(ratingstablename, n, openconnection, adaptive=True)
+        with openconnection.cursor() as cur:
+            cur.execute("SELECT boundaries FROM partition_metadata WHERE partition_type = 'range'")
+            boundaries = cur.fetchone()[0]
+        openconnection.commit()
+        report = testpartitioning(ratingstablename, n, openconnection, RANGE_TABLE_PREFIX, 0, loaded[0],
+                                  boundaryconditions(boundaries))
+        if max(report['partitionrows']) > uniform:
+            raise Exception("adaptive rangepartition made a partition of {0} rows, uniform bands at most {1}".format(
+                max(report['partitionrows']), uniform))
+        checkpartitionstats(MyAssignment, 'range', n, openconnection)
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    finally:
+        openconnection.rollback()
+        if previouscachedir is None:
+            os.environ.pop('RATINGS_CACHE_DIR', None)
+        else:
+            os.environ['RATINGS_CACHE_DIR'] = previouscachedir
+        shutil.rmtree(cachedir, ignore_errors=True)
+    return [True, None]
+
+
+def boundaryconditions(boundaries):
+    """
+    Condition each range partition's rows must satisfy for the upper bounds @boundaries: (boundaries[i - 1],
+    boundaries[i]], without a lower bound for the first partition and an upper bound for the last one
+    """
+    conditions = []
+    for i in range(len(boundaries)):
+        bounds = []
+        if i > 0:
+            bounds.append("{0} > {1!r}".format(RATING_COLNAME, float(boundaries[i - 1])))
+        if i < len(boundaries) - 1:
+            bounds.append("{0} <= {1!r}".format(RATING_COLNAME, float(boundaries[i])))
+        conditions.append(" AND ".join(bounds) or "{0} IS NOT NULL".format(RATING_COLNAME))
+    return conditions
+
+
+def checkpartitionmetadata(partitiontype, n, openconnection, boundaries=None, lastused=None):
+    """
+    Raise if partition_metadata does not record @n @partitiontype partitions, with the upper bounds @boundaries
+    (range) or the last used ordinal @lastused (round robin) when given
+    """
+    with openconnection.cursor() as cur:
+        cur.execute("SELECT partition_count, boundaries, last_used FROM partition_metadata WHERE partition_type = %s",
+                    (partitiontype,))
+        row = cur.fetchone()
+    openconnection.commit()
+    if row is None or row[0] != n:
+        raise Exception("Expected {0} {1} partitions in partition_metadata, but found {2}".format(
+            n, partitiontype, row and row[0]))
+    if boundaries is not None and (len(row[1] or []) != len(boundaries)
+                                   or any(abs(a - b) > 1e-9 for a, b in zip(row[1], boundaries))):
+        raise Exception("Expected the {0} boundaries {1} in partition_metadata, but found {2}".format(
+            partitiontype, boundaries, row[1]))
+    if lastused is not None and row[2] != lastused:
+        raise Exception("Expected {0} as last used ordinal of {1}, but found {2}".format(lastused, partitiontype, row[2]))
+
+
+def testrepartition(MyAssignment, MyRepartition, ratingstablename, n, openconnection):
+    """
+    Tests MyRepartition.splitrangepartition, mergerangepartitions and growroundrobinpartitions on @n range and
+    round robin partitions of the loaded @ratingstablename. After each step every row must sit in its partition
+    (row checksums against the table), partition_metadata must record the new partitions and checkpartitionstats
+    must pass. Merging the split back must restore the partitions row for row, and growing must leave every row
+    where roundrobinpartition over the new number of partitions puts it, with the next insert continuing the cycle.
+    """
+    def scanpartitions(prefix, count):
+        with openconnection.cursor() as cur:
+            return [scantable(cur, '{0}{1}'.format(prefix, i))[:2] for i in range(count)]
+
+    try:
+        MyAssignment.rangepartition(ratingstablename, n, openconnection)
+        MyAssignment.roundrobinpartition(ratingstablename, n, openconnection)
+        with openconnection.cursor() as cur:
+            rows = scantable(cur, ratingstablename)[0]
+        uniform = [5.0 * (i + 1) / n for i in range(n)]
+        before = scanpartitions(RANGE_TABLE_PREFIX, n)
+
+        splitvalue = MyRepartition.splitrangepartition(1, openconnection=openconnection)
+        split = uniform[:1] + [splitvalue] + uniform[1:]
+        if not uniform[0] < splitvalue < uniform[1]:
+            raise Exception("splitrangepartition split {0}1 at {1}, outside its band ({2}, {3}]".format(
+                RANGE_TABLE_PREFIX, splitvalue, uniform[0], uniform[1]))
+        checkpartitionmetadata('range', n + 1, openconnection, boundaries=split)
+        testpartitioning(ratingstablename, n + 1, openconnection, RANGE_TABLE_PREFIX, 0, rows,
+                         boundaryconditions(split))
+        checkpartitionstats(MyAssignment, 'range', n + 1, openconnection)
+
+        MyRepartition.mergerangepartitions(1, openconnection=openconnection)
+        checkpartitionmetadata('range', n, openconnection, boundaries=uniform)
+        testpartitioning(ratingstablename, n, openconnection, RANGE_TABLE_PREFIX, 0, rows, boundaryconditions(uniform))
+        checkpartitionstats(MyAssignment, 'range', n, openconnection)
+        merged = scanpartitions(RANGE_TABLE_PREFIX, n)
+        if merged != before:
+            raise Exception("Merging the split back gave (rows, checksum) {0}, expected {1}".format(merged, before))
+
+        grown = n + 2
+        MyRepartition.growroundrobinpartitions(grown, openconnection=openconnection)
+        checkpartitionmetadata('rrobin', grown, openconnection, lastused=rows - 1)
+        testpartitioning(ratingstablename, grown, openconnection, RROBIN_TABLE_PREFIX, 0, rows, roundrobin=True)
+        checkpartitionstats(MyAssignment, 'rrobin', grown, openconnection)
+        after = scanpartitions(RROBIN_TABLE_PREFIX, grown)
+        MyAssignment.roundrobinpartition(ratingstablename, grown, openconnection)
+        built = scanpartitions(RROBIN_TABLE_PREFIX, grown)
+        if after != built:
+            raise Exception("growroundrobinpartitions left (rows, checksum) {0}, roundrobinpartition builds {1}".format(
+                after, built))
+
+        MyRepartition.growroundrobinpartitions(grown + 1, openconnection=openconnection)
+        with openconnection.cursor() as cur:
+            cur.execute('SELECT MAX(userid) from {0}'.format(ratingstablename))
+            userid = int(cur.fetchone()[0]) + 1
+        openconnection.commit()
+        MyAssignment.roundrobininsert(ratingstablename, userid, 1, 3.0, openconnection)
+        expected = '{0}{1}'.format(RROBIN_TABLE_PREFIX, rows % (grown + 1))
+        if not testrangerobininsert(expected, 1, openconnection, 3.0, userid):
+            raise Exception("The first insert after growing to {0} partitions did not go to {1}".format(
+                grown + 1, expected))
+        checkpartitionstats(MyAssignment, 'rrobin', grown + 1, openconnection)
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    finally:
+        openconnection.rollback()
+    return [True, None]
+
+
+def checkquery(name, result, expected, openconnection, partitions=None):
+    """
+    Raise if the rows of the QueryResult @result differ from @expected (the plain SQL answer), as multisets,
+    or if it scanned a different number of partitions than @partitions when given
+    """
+    rows = sorted(result)
+    if rows != sorted(expected):
+        raise Exception("{0} returned {1} rows, plain SQL {2} (or the same number of different rows)".format(
+            name, len(rows), len(expected)))
+    if result.rows != len(rows):
+        raise Exception("{0} reported {1} rows but yielded {2}".format(name, result.rows, len(rows)))
+    if partitions is not None and len(result.partitions) != partitions:
+        raise Exception("{0} scanned {1} partitions, expected {2}".format(name, result.partitions, partitions))
+    openconnection.commit()
+
+
+def testqueries(MyAssignment, MyQuery, ratingstablename, filepath, n, openconnection):
+    """
+    Tests MyQuery.rangequery, pointquery and userquery against plain SQL on @ratingstablename: on the base table
+    alone, then over @n round robin partitions, adaptive range partitions (which rangequery must prune to the
+    bands overlapping the interval) and hash partitions. Intervals include single values, the partition
+    boundaries, ratings outside [0, 5] and an empty interval; keys include missing users and movies.
+    """
+    intervals = [(0, 5), (1.5, 3.5), (2, 2), (4.5, 5), (-1, 0.5), (3.2, 3.1), (5.5, 10)]
+
+    def plain(query, params):
+        with openconnection.cursor() as cur:
+            cur.execute(query.format(ratingstablename), params)
+            rows = cur.fetchall()
+        openconnection.commit()
+        return rows
+
+    def checkall(boundaries=None):
+        for low, high in intervals:
+            expected = plain("SELECT userid, movieid, rating FROM {0} WHERE rating >= %s AND rating <= %s", (low, high))
+            partitions = None
+            if boundaries:
+                # Band i is (boundaries[i - 1], boundaries[i]], open below for the first and above for the last
+                partitions = sum(1 for i in range(len(boundaries))
+                                 if (i == len(boundaries) - 1 or low <= boundaries[i])
+                                 and (i == 0 or high > boundaries[i - 1]))
+            checkquery("rangequery({0}, {1})".format(low, high),
+                       MyQuery.rangequery(ratingstablename, low, high, openconnection=openconnection), expected,
+                       openconnection, partitions)
+        for userid, movieid in keys:
+            checkquery("pointquery({0}, {1})".format(userid, movieid),
+                       MyQuery.pointquery(ratingstablename, userid, movieid, openconnection=openconnection),
+                       plain("SELECT userid, movieid, rating FROM {0} WHERE userid = %s AND movieid = %s",
+                             (userid, movieid)), openconnection)
+            checkquery("userquery({0})".format(userid),
+                       MyQuery.userquery(ratingstablename, userid, openconnection=openconnection),
+                       plain("SELECT userid, movieid, rating FROM {0} WHERE userid = %s", (userid,)),
+                       openconnection)
+
+    try:
+        deleteAllPublicTables(openconnection)
+        MyAssignment.invalidate_partition_metadata()
+        MyAssignment.loadratings(ratingstablename, filepath, openconnection)
+        keys = [tuple(row) for row in plain("SELECT userid, movieid FROM {0} ORDER BY userid, movieid LIMIT 1", ())]
+        keys += [tuple(row) for row in plain("SELECT userid, movieid FROM {0} ORDER BY userid DESC, movieid DESC "
+                                             "LIMIT 1", ())]
+        keys += [(keys[0][0], -1), (-1, keys[0][1])]
+        checkall()
+
+        MyAssignment.roundrobinpartition(ratingstablename, n, openconnection)
+        checkall()
+
+        MyAssignment.rangepartition(ratingstablename, n, openconnection, adaptive=True)
+        with openconnection.cursor() as cur:
+            cur.execute("SELECT boundaries FROM partition_metadata WHERE partition_type = 'range'")
+            boundaries = cur.fetchone()[0]
+        openconnection.commit()
+        checkall(boundaries)
+
+        MyAssignment.hashpartition(ratingstablename, n, openconnection)
+        checkall(boundaries)
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    finally:
+        openconnection.rollback()
+    return [True, None]
+
+
+def checkdistinctcount(name, estimate, exact, precision=12):
+    """Raise if the HyperLogLog @estimate is more than three standard errors (1.04 / sqrt(2^@precision)) off @exact"""
+    tolerance = 3 * 1.04 / (1 << precision) ** 0.5 * exact + 1
+    if abs(estimate - exact) > tolerance:
+        raise Exception("{0} estimated {1} distinct values, {2} exactly (tolerance {3:.1f})".format(
+            name, estimate, exact, tolerance))
+
+
+def testaggregate(MyAssignment, MyAggregate, ratingstablename, filepath, n, openconnection):
+    """
+    Tests MyAggregate.aggregate against plain SQL on the base table and on @n range, round robin and hash
+    partitions: Count, Sum, Min, Max and Avg per movieid exactly (Avg to 1e-9), and sketches mixed with plain
+    aggregates, which aggregate() computes with GROUPING SETS over several keys: Histogram and Quantiles exactly,
+    Quantiles over buckets to the bucket holding the exact value, and DistinctCount within three standard errors.
+    """
+    A = MyAggregate
+    movies = 200
+    quantiles = (0, 0.1, 0.25, 0.5, 0.9, 1)
+
+    def plain(query, params=()):
+        with openconnection.cursor() as cur:
+            cur.execute(query.format(ratingstablename), params)
+            rows = cur.fetchall()
+        openconnection.commit()
+        return rows
+
+    def checkbuckets(name, lower, exact, width):
+        for bucket, value in zip(lower, exact):
+            if not bucket <= value < bucket + width:
+                raise Exception("{0} returned the bucket {1} for the value {2} (width {3})".format(
+                    name, bucket, value, width))
+
+    def checkall(partitiontype):
+        name = "aggregate over {0}".format(partitiontype or ratingstablename)
+        result = A.aggregate(ratingstablename, [A.Count(), A.Sum('userid'), A.Min('rating'), A.Max('rating'),
+                                                A.Avg('rating')], groupby=['movieid'], where='movieid < %s',
+                             params=(movies,), partition_type=partitiontype, openconnection=openconnection)
+        expected = plain("SELECT movieid, count(*), sum(userid), min(rating), max(rating), avg(rating) FROM {0} "
+                         "WHERE movieid < %s GROUP BY movieid ORDER BY movieid", (movies,))
+        if len(result) != len(expected) or any(
+                row[:5] != exact[:5] or abs(row[5] - exact[5]) > 1e-9 for row, exact in zip(result, expected)):
+            raise Exception("{0}: Count/Sum/Min/Max/Avg per movieid differ from plain SQL".format(name))
+
+        result = A.aggregate(ratingstablename, [A.Count(), A.Histogram('rating'), A.Quantiles('rating', quantiles),
+                                                A.Quantiles('rating', (0.5,), width=1.0), A.DistinctCount('userid'),
+                                                A.Avg('rating')],
+                             groupby=['movieid'], where='movieid < %s', params=(movies,),
+                             partition_type=partitiontype, openconnection=openconnection)
+        histograms = {}
+        for movieid, rating, count in plain("SELECT movieid, rating, count(*) FROM {0} WHERE movieid < %s "
+                                            "GROUP BY movieid, rating", (movies,)):
+            histograms.setdefault(movieid, {})[rating] = count
+        expected = plain("SELECT movieid, count(*), percentile_disc(%s) WITHIN GROUP (ORDER BY rating), "
+                         "count(DISTINCT userid), avg(rating) FROM {0} WHERE movieid < %s GROUP BY movieid "
+                         "ORDER BY movieid", (list(quantiles), movies))
+        if [row[0] for row in result] != [row[0] for row in expected]:
+            raise Exception("{0}: the sketch query returned other movieid groups than plain SQL".format(name))
+        for row, (movieid, count, exactquantiles, distinct, avg) in zip(result, expected):
+            if row[1] != count or row[2] != histograms[movieid] or list(row[3]) != exactquantiles \
+                    or abs(row[6] - avg) > 1e-9:
+                raise Exception("{0}: Count/Histogram/Quantiles/Avg of movieid {1} differ from plain SQL".format(
+                    name, movieid))
+            checkbuckets("{0}: Quantiles by bucket of movieid {1}".format(name, movieid), row[4],
+                         exactquantiles[3:4], 1.0)
+            checkdistinctcount("{0}: DistinctCount(userid) of movieid {1}".format(name, movieid), row[5], distinct)
+
+        [row] = A.aggregate(ratingstablename, [A.DistinctCount('userid'), A.DistinctCount('movieid', precision=14),
+                                               A.Quantiles('rating', quantiles, width=0.5),
+                                               A.Histogram('rating', width=0.5)],
+                            partition_type=partitiontype, openconnection=openconnection)
+        [(users, movieids, exactquantiles)] = plain("SELECT count(DISTINCT userid), count(DISTINCT movieid), "
+                                                    "percentile_disc(%s) WITHIN GROUP (ORDER BY rating) FROM {0}",
+                                                    (list(quantiles),))
+        checkdistinctcount("{0}: DistinctCount(userid)".format(name), row[0], users)
+        checkdistinctcount("{0}: DistinctCount(movieid)".format(name), row[1], movieids, precision=14)
+        checkbuckets("{0}: Quantiles by bucket".format(name), row[2], exactquantiles, 0.5)
+        if row[3] != dict(plain("SELECT floor(rating / 0.5) * 0.5 AS b, count(*) FROM {0} GROUP BY b ORDER BY b")):
+            raise Exception("{0}: Histogram by bucket differs from plain SQL".format(name))
+
+    try:
+        deleteAllPublicTables(openconnection)
+        MyAssignment.invalidate_partition_metadata()
+        MyAssignment.loadratings(ratingstablename, filepath, openconnection)
+        checkall(None)
+        MyAssignment.rangepartition(ratingstablename, n, openconnection)
+        MyAssignment.roundrobinpartition(ratingstablename, n, openconnection)
+        MyAssignment.hashpartition(ratingstablename, n, openconnection)
+        for partitiontype in ('range', 'rrobin', 'hash'):
+            checkall(partitiontype)
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    finally:
+        openconnection.rollback()
+    return [True, None]
+
+
+def testratingwriter(MyAssignment, MyWriter, ratingstablename, partitiontype, n, openconnection, firstuserid,
+                     rows=2000, producers=8):
+    """
+    Tests MyWriter.RatingWriter over the @n existing @partitiontype ('range' or 'rrobin') partitions: @rows
+    ratings submitted from @producers threads must all be committed into the right partitions, a duplicate key
+    must fail only its own future, and submit() must be refused after close(). The rows are removed afterwards,
+    after which the partition statistics are rebuilt and the round robin cycle continues after the remaining rows,
+    as if the writer had never run.
+    :param firstuserid: Smallest userid of the inserted rows; no rating of such a user may exist yet
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    prefix = RANGE_TABLE_PREFIX if partitiontype == 'range' else RROBIN_TABLE_PREFIX
+    tables = ['{0}{1}'.format(prefix, i) for i in range(n)]
+    newrows = [(firstuserid + i // 100, i % 100 + 1, (i % 10 + 1) / 2) for i in range(rows)]
+    try:
+        writer = MyWriter.RatingWriter(ratingstablename, partitiontype, max_batch=100)
+        with ThreadPoolExecutor(max_workers=producers) as executor:
+            futures = list(executor.map(lambda row: writer.submit(*row), newrows))
+        for future in futures:
+            future.result()
+
+        duplicate, fresh = writer.submit(*newrows[0]), writer.submit(firstuserid - 1, 1, 1.0)
+        writer.close()
+        if duplicate.exception() is None:
+            raise Exception("RatingWriter accepted a duplicate of an already written rating")
+        fresh.result()
+        try:
+            writer.submit(firstuserid - 1, 2, 1.0)
+            raise Exception("RatingWriter accepted a rating after close()")
+        except RuntimeError:
+            pass
+
+        with openconnection.cursor() as cur:
+            total = 0
+            for i, table in enumerate(tables):
+                cur.execute("SELECT COUNT(*) FROM {0} WHERE {1} >= %s".format(table, USER_ID_COLNAME),
+                            (firstuserid - 1,))
+                total += cur.fetchone()[0]
+                if partitiontype == 'range':
+                    cur.execute("SELECT COUNT(*) FROM {0} WHERE {1} >= %s AND NOT ({2})".format(
+                        table, USER_ID_COLNAME, rangebandconditions(n)[i]), (firstuserid - 1,))
+                    if cur.fetchone()[0]:
+                        raise Exception("RatingWriter put ratings outside the band of {0}".format(table))
+            if total != rows + 1:
+                raise Exception("Expected {0} ratings written by RatingWriter in {1}*, but found {2}".format(
+                    rows + 1, prefix, total))
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    finally:
+        openconnection.rollback()
+        with openconnection.cursor() as cur:
+            for table in tables + [ratingstablename]:
+                cur.execute("DELETE FROM {0} WHERE {1} >= %s".format(table, USER_ID_COLNAME), (firstuserid - 1,))
+            if partitiontype == 'rrobin':
+                cur.execute("SELECT COUNT(*) FROM ({0}) AS T".format(
+                    " UNION ALL ".join("SELECT 1 FROM {0}".format(table) for table in tables)))
+                cur.execute(MyAssignment.restart_rrobin_slots_command(cur.fetchone()[0]))
+        openconnection.commit()
+        MyAssignment.rebuild_partition_stats(partitiontype, openconnection)
+    return [True, None]
+
+
+# DISTRIBUTED Functions: partitions placed on several nodes (databases) by the `nodes` argument of the builders
+def getnodeconnection(dsn):
+    """Connection to the node @dsn; settings the DSN leaves out are taken from .env"""
+    params = dict(dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD, host=DB_HOST, port=DB_PORT)
+    params.update(psycopg2.extensions.parse_dsn(dsn))
+    return psycopg2.connect(**params)
+
+
+def testdistributedpartitioning(ratingstablename, n, openconnection, partitiontableprefix, partitiontype, nodes,
+                                ACTUAL_ROWS_IN_INPUT_FILE, conditions=None, roundrobin=False):
+    """
+    Test a partitioning placed on @nodes: the catalog must put partition i on nodes[i % len(nodes)], the partition
+    tables must exist there and only there, and Completeness, Disjointness, Reconstruction and placement of every
+    row are checked as in testpartitioning, with every partition read from its own node
+    :return: the verification report
+    """
+    placement = [nodes[i % len(nodes)] for i in range(n)]
+    with openconnection.cursor() as cur:
+        cur.execute("SELECT nodes FROM partition_metadata WHERE partition_type = %s", (partitiontype,))
+        row = cur.fetchone()
+        if not row or row[0] != placement:
+            raise Exception("Expected the {0} partitions on {1}, but the catalog holds {2}".format(
+                partitiontype, placement, row and row[0]))
+        rows, checksum, _ = scantable(cur, ratingstablename)
+
+    partitions = []
+    for node in dict.fromkeys(placement):
+        with getnodeconnection(node) as conn, conn.cursor() as cur:
+            checkpartitioncount(cur, placement.count(node), partitiontableprefix)
+        conn.close()
+    for i in range(n):
+        conn = getnodeconnection(placement[i])
+        try:
+            with conn.cursor() as cur:
+                partitions.append(scantable(cur, '{0}{1}'.format(partitiontableprefix, i),
+                                            conditions[i] if conditions else None))
+        finally:
+            conn.close()
+
+    report = partitionreport(rows, checksum, partitions)
+    checkverification(report, ACTUAL_ROWS_IN_INPUT_FILE, partitiontableprefix, 0,
+                      roundrobincounts(report['rows'], n) if roundrobin else None)
+    return report
+
+
+def testdistributedpartition(MyAssignment, partitionname, ratingstablename, n, openconnection, nodes,
+                             ACTUAL_ROWS_IN_INPUT_FILE):
+    """Tests MyAssignment.@partitionname (rangepartition, roundrobinpartition or hashpartition) with @nodes"""
+    partitiontype, prefix, conditions = {
+        'rangepartition': ('range', RANGE_TABLE_PREFIX, rangebandconditions(n)),
+        'roundrobinpartition': ('rrobin', RROBIN_TABLE_PREFIX, None),
+        'hashpartition': ('hash', HASH_TABLE_PREFIX, hashconditions(n)),
+    }[partitionname]
+    try:
+        getattr(MyAssignment, partitionname)(ratingstablename, n, openconnection, nodes=nodes)
+        testdistributedpartitioning(ratingstablename, n, openconnection, prefix, partitiontype, nodes,
+                                    ACTUAL_ROWS_IN_INPUT_FILE, conditions, roundrobin=partitiontype == 'rrobin')
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    return [True, None]
+
+
+def testdistributedinsert(MyAssignment, insertname, ratingstablename, userid, itemid, rating, node,
+                          expectedtablename):
+    """Tests MyAssignment.@insertname by checking whether the tuple is inserted in the expected table on @node"""
+    try:
+        getattr(MyAssignment, insertname)(ratingstablename, userid, itemid, rating)
+        conn = getnodeconnection(node)
+        try:
+            if not testrangerobininsert(expectedtablename, itemid, conn, rating, userid):
+                raise Exception('{0} failed! Couldnt find ({1}, {2}, {3}) tuple in {4} table on {5}'.format(
+                    insertname, userid, itemid, rating, expectedtablename, node))
+        finally:
+            conn.close()
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    return [True, None]
+
+
+def testdistributedatomicity(MyAssignment, ratingstablename, userid, itemid, rating, node, openconnection):
+    """
+    A hashinsert whose node write fails (the key already exists in the partition but not in @ratingstablename)
+    must leave @ratingstablename unchanged as well
+    """
+    try:
+        with openconnection.cursor() as cur:
+            cur.execute("DELETE FROM {0} WHERE userid = %s AND movieid = %s".format(ratingstablename), (userid, itemid))
+        openconnection.commit()
+        try:
+            MyAssignment.hashinsert(ratingstablename, userid, itemid, rating)
+            raise Exception("hashinsert of a key already in its partition did not fail")
+        except psycopg2.IntegrityError:
+            pass
+        with openconnection.cursor() as cur:
+            cur.execute("SELECT COUNT(*) FROM {0} WHERE userid = %s AND movieid = %s".format(ratingstablename),
+                        (userid, itemid))
+            if cur.fetchone()[0]:
+                raise Exception("hashinsert wrote ({0}, {1}) to {2} although its partition write on {3} failed".format(
+                    userid, itemid, ratingstablename, node))
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    return [True, None]
+
+
+def testdistributedrecovery(MyAssignment, tablename, node, openconnection):
+    """
+    Leave two transactions prepared on @node as a crash after PREPARE TRANSACTION would, one of them recorded as
+    committed in partition_commit_log, and check that recovery commits exactly that one
+    """
+    try:
+        rows = []
+        for i, logged in enumerate((True, False)):
+            gid = '{0}recoverytest{1}'.format(MyAssignment.DISTRIBUTED_GID_PREFIX, i)
+            row = (2000000000 - i, 1, 2.5)
+            conn = getnodeconnection(node)
+            conn.tpc_begin(conn.xid(0, gid, '0'))
+            with conn.cursor() as cur:
+                cur.execute("INSERT INTO {0} (userid, movieid, rating) VALUES (%s, %s, %s)".format(tablename), row)
+            conn.tpc_prepare()
+            conn.close()
+            if logged:
+                with openconnection.cursor() as cur:
+                    cur.execute("INSERT INTO partition_commit_log (gid) VALUES (%s)", (gid,))
+                openconnection.commit()
+            rows.append(row)
+
+        result = MyAssignment.recover_distributed_transactions(min_age=0)
+        if result != {'committed': 1, 'rolled_back': 1}:
+            raise Exception("Expected recovery to commit 1 and roll back 1 transaction, but got {0}".format(result))
+        conn = getnodeconnection(node)
+        try:
+            if not testrangerobininsert(tablename, rows[0][1], conn, rows[0][2], rows[0][0]):
+                raise Exception("Recovery did not commit the logged transaction")
+            if testrangerobininsert(tablename, rows[1][1], conn, rows[1][2], rows[1][0]):
+                raise Exception("Recovery committed a transaction that never reached its commit decision")
+            with conn.cursor() as cur:
+                cur.execute("DELETE FROM {0} WHERE userid = %s".format(tablename), (rows[0][0],))
+            conn.commit()
+        finally:
+            conn.close()
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    return [True, None]
+
+
+# ASYNC Functions: the same checks for the coroutines of src/async_interface.py. The functions under test use
+# their own asyncpg connections; @openconnection is the psycopg2 connection the results are checked with.
+async def testasyncloadratings(AsyncAssignment, ratingstablename, filepath, openconnection, rowsininpfile):
+    try:
+        await AsyncAssignment.loadratings(ratingstablename, filepath)
+        with openconnection.cursor() as cur:
+            cur.execute('SELECT COUNT(*) from {0}'.format(ratingstablename))
+            count = int(cur.fetchone()[0])
+            if count != rowsininpfile:
+                raise Exception(
+                    'Expected {0} rows, but {1} rows in \'{2}\' table'.format(rowsininpfile, count, ratingstablename))
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    return [True, None]
+
+
+async def testasyncrangepartition(AsyncAssignment, ratingstablename, n, openconnection, partitionstartindex,
+                                  ACTUAL_ROWS_IN_INPUT_FILE, workers=1):
+    try:
+        await AsyncAssignment.rangepartition(ratingstablename, n, workers=workers)
+        testpartitioning(ratingstablename, n, openconnection, RANGE_TABLE_PREFIX, partitionstartindex,
+                         ACTUAL_ROWS_IN_INPUT_FILE, rangebandconditions(n))
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    return [True, None]
+
+
+async def testasyncroundrobinpartition(AsyncAssignment, ratingstablename, n, openconnection, partitionstartindex,
+                                       ACTUAL_ROWS_IN_INPUT_FILE, workers=1):
+    try:
+        await AsyncAssignment.roundrobinpartition(ratingstablename, n, workers=workers)
+        testpartitioning(ratingstablename, n, openconnection, RROBIN_TABLE_PREFIX, partitionstartindex,
+                         ACTUAL_ROWS_IN_INPUT_FILE, roundrobin=True)
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    return [True, None]
+
+
+async def testasynchashpartition(AsyncAssignment, ratingstablename, n, openconnection, partitionstartindex,
+                                 ACTUAL_ROWS_IN_INPUT_FILE, workers=1):
+    try:
+        await AsyncAssignment.hashpartition(ratingstablename, n, workers=workers)
+        testpartitioning(ratingstablename, n, openconnection, HASH_TABLE_PREFIX, partitionstartindex,
+                         ACTUAL_ROWS_IN_INPUT_FILE, hashconditions(n))
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    return [True, None]
+
+
+async def testasyncinsert(AsyncAssignment, insertname, ratingstablename, userid, itemid, rating, openconnection,
+                          expectedtablename):
+    """
+    Tests AsyncAssignment.@insertname (rangeinsert, roundrobininsert or hashinsert) by checking whether the tuple
+    is inserted in the expected table
+    """
+    try:
+        await getattr(AsyncAssignment, insertname)(ratingstablename, userid, itemid, rating)
+        if not testrangerobininsert(expectedtablename, itemid, openconnection, rating, userid):
+            raise Exception('{0} failed! Couldnt find ({1}, {2}, {3}) tuple in {4} table'.format(
+                insertname, userid, itemid, rating, expectedtablename))
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    return [True, None]
+
+
+async def testasyncconcurrentinserts(AsyncAssignment, insertname, ratingstablename, n, count, firstuserid,
+                                     openconnection, partitiontableprefix, conditions=None, roundrobin=False):
+    """
+    Run @count AsyncAssignment.@insertname calls at once (new keys from @firstuserid on), then verify the whole
+    partitioning again: no row may be lost, duplicated or misplaced, and round robin partitions must stay balanced
+    """
+    try:
+        with openconnection.cursor() as cur:
+            cur.execute('SELECT COUNT(*) from {0}'.format(ratingstablename))
+            rows = int(cur.fetchone()[0])
+        insert = getattr(AsyncAssignment, insertname)
+        await asyncio.gather(*(insert(ratingstablename, firstuserid + i // 100, i % 100 + 1, (i % 10 + 1) / 2)
+                               for i in range(count)))
+        testpartitioning(ratingstablename, n, openconnection, partitiontableprefix, 0, rows + count, conditions,
+                         roundrobin)
+    except Exception as e:
+        traceback.print_exc()
+        return [False, e]
+    return [True, None]